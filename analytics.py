@@ -0,0 +1,185 @@
+import json
+from collections import Counter
+
+from sqlalchemy import case, func
+
+from models import db, Artist, ArtistBookings, CityShows, GenreShows, Show, ShowArchive, Venue, VenueMonthlyShows
+
+#----------------------------------------------------------------------------#
+# Analytics rollups.
+#----------------------------------------------------------------------------#
+# The dashboards never read the Show table: record_shows() adds every listed
+# show to a few small counter tables in the transaction that inserts it, and
+# the dashboards read those. backfill() rebuilds them from the full history.
+
+
+def _insert(model):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f'analytics rollups need an upsert, not supported on {dialect}')
+    return insert(model.__table__)
+
+
+def _increment(model, keys, rows):
+    if not rows:
+        return
+    table = model.__table__
+    statement = _insert(model)
+    values = {"show_count": table.c.show_count + statement.excluded.show_count}
+    if 'last_start_time' in table.c:
+        values["last_start_time"] = case(
+            (statement.excluded.last_start_time > func.coalesce(table.c.last_start_time, ''),
+             statement.excluded.last_start_time),
+            else_=table.c.last_start_time)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=keys, set_=values), rows)
+
+
+def _rollup_rows(shows):
+    # The show form hands the ids over as strings
+    shows = [dict(show, artist_id=int(show["artist_id"]), venue_id=int(show["venue_id"]))
+             for show in shows]
+    venue_ids = {show["venue_id"] for show in shows}
+    artist_ids = {show["artist_id"] for show in shows}
+    locations = {venue_id: (city, state) for venue_id, city, state in db.session.query(
+        Venue.id, Venue.city, Venue.state).filter(Venue.id.in_(venue_ids))}
+    genres = {}
+    for artist_id, artist_genres in db.session.query(
+            Artist.id, Artist.genres).filter(Artist.id.in_(artist_ids)):
+        try:
+            genres[artist_id] = set(json.loads(artist_genres or '[]'))
+        except ValueError:
+            genres[artist_id] = set()
+
+    venue_months = Counter()
+    cities = Counter()
+    genre_counts = Counter()
+    artist_counts = Counter()
+    artist_last_show = {}
+    for show in shows:
+        start_time = str(show["start_time"])
+        venue_months[(show["venue_id"], start_time[:7])] += 1
+        if show["venue_id"] in locations:
+            cities[locations[show["venue_id"]]] += 1
+        for genre in genres.get(show["artist_id"], ()):
+            genre_counts[genre] += 1
+        artist_counts[show["artist_id"]] += 1
+        artist_last_show[show["artist_id"]] = max(
+            start_time, artist_last_show.get(show["artist_id"], ''))
+
+    return [
+        (VenueMonthlyShows, ['venue_id', 'month'], [
+            {"venue_id": venue_id, "month": month, "show_count": count}
+            for (venue_id, month), count in venue_months.items()]),
+        (CityShows, ['city', 'state'], [
+            {"city": city, "state": state or '', "show_count": count}
+            for (city, state), count in cities.items()]),
+        (GenreShows, ['genre'], [
+            {"genre": genre, "show_count": count}
+            for genre, count in genre_counts.items()]),
+        (ArtistBookings, ['artist_id'], [
+            {"artist_id": artist_id, "show_count": count,
+             "last_start_time": artist_last_show[artist_id]}
+            for artist_id, count in artist_counts.items()]),
+    ]
+
+
+def record_shows(shows):
+    '''Add shows (dicts with artist_id, venue_id and start_time) to the
+    rollups. Runs in the caller's transaction, the caller commits.'''
+    if not shows:
+        return
+    for model, keys, rows in _rollup_rows(shows):
+        _increment(model, keys, rows)
+
+
+def forget_shows(shows):
+    '''Take deleted shows back out of the rollups, so they agree with what
+    backfill() rebuilds. Runs in the caller's transaction, after the shows
+    are deleted and before their artists and venues are.'''
+    if not shows:
+        return
+    rollups = _rollup_rows(shows)
+    for model, keys, rows in rollups:
+        for row in rows:
+            row["show_count"] = -row["show_count"]
+            if "last_start_time" in row:
+                row["last_start_time"] = ''
+        _increment(model, keys, rows)
+        db.session.query(model).filter(model.show_count <= 0).delete(
+            synchronize_session=False)
+
+    # The latest show of an artist may have been one of them
+    artist_ids = [row["artist_id"] for row in rollups[-1][2]]
+    last_start_times = {}
+    for model in (Show, ShowArchive):
+        for artist_id, start_time in db.session.query(
+                model.artist_id, func.max(model.start_time)).filter(
+                model.artist_id.in_(artist_ids)).group_by(model.artist_id):
+            last_start_times[artist_id] = max(start_time, last_start_times.get(artist_id, ''))
+    for artist_id in artist_ids:
+        db.session.query(ArtistBookings).filter(
+            ArtistBookings.artist_id == artist_id).update(
+            {"last_start_time": last_start_times.get(artist_id)}, synchronize_session=False)
+
+
+def backfill(chunk_size=5000, progress=None):
+    '''Rebuild every rollup from Show and ShowArchive, one transaction per
+    chunk. Shows listed while it runs may be counted twice or not at all, run
+    it when no shows are being listed.'''
+    for model in (VenueMonthlyShows, CityShows, GenreShows, ArtistBookings):
+        db.session.query(model).delete(synchronize_session=False)
+    db.session.commit()
+
+    processed = 0
+    for model in (ShowArchive, Show):
+        last_id = None
+        while True:
+            query = db.session.query(
+                model.id, model.artist_id, model.venue_id, model.start_time)
+            if last_id is not None:
+                query = query.filter(model.id > last_id)
+            rows = query.order_by(model.id).limit(chunk_size).all()
+            if not rows:
+                break
+            record_shows([{"artist_id": artist_id, "venue_id": venue_id, "start_time": start_time}
+                          for _, artist_id, venue_id, start_time in rows])
+            db.session.commit()
+            last_id = rows[-1][0]
+            processed += len(rows)
+            if progress is not None:
+                progress(processed)
+    return processed
+
+
+#  Dashboards
+#  ----------------------------------------------------------------
+
+def venue_monthly_shows(venue_id, months=12):
+    rows = VenueMonthlyShows.query.filter_by(venue_id=venue_id).order_by(
+        VenueMonthlyShows.month.desc()).limit(months).all()
+    return [{"month": row.month, "show_count": row.show_count}
+            for row in reversed(rows)]
+
+
+def busiest_cities(limit=10):
+    return [{"city": row.city, "state": row.state, "show_count": row.show_count}
+            for row in CityShows.query.order_by(
+                CityShows.show_count.desc()).limit(limit)]
+
+
+def top_genres(limit=10):
+    return [{"genre": row.genre, "show_count": row.show_count}
+            for row in GenreShows.query.order_by(
+                GenreShows.show_count.desc()).limit(limit)]
+
+
+def most_booked_artists(limit=10):
+    return [{"artist_id": row.artist_id, "show_count": row.show_count,
+             "last_start_time": row.last_start_time}
+            for row in ArtistBookings.query.order_by(
+                ArtistBookings.show_count.desc()).limit(limit)]
@@ -1,6 +1,21 @@
-from flask import Flask, render_template, request, flash, redirect, url_for
-from sqlalchemy import desc
+from flask import Flask, render_template, request, flash, redirect, url_for, jsonify, abort
+from sqlalchemy import and_, desc
 from models import db, Artist, Show, Venue
+from matching import match_index
+from geo import MAX_RADIUS_MILES, geocoder, venue_grid
+from sessions import init_sessions
+from profiling import init_profiler
+from scheduling import schedule_shows
+from search_cache import search_cache
+from versioning import EditConflict, compare_and_swap
+from outbox import notify_consumers, record_change, snapshot, wait_for_changes
+from archive import all_archived_shows, archive_shows, archived_shows
+import analytics
+from http_cache import conditional, init_compression
+from ratelimit import init_limiter, limit
+import sitemap
+from deletion import MODES as DELETE_MODES, bulk_delete
+from templating import init_templates, render_metrics
 from flask_migrate import Migrate
 from forms import *
 from logging import Formatter, FileHandler
@@ -8,10 +23,13 @@ import logging
 from flask_sqlalchemy import SQLAlchemy
 from flask_moment import Moment
 import babel
+import click
 from datetime import datetime
 from dateutil import parser
 import phonenumbers
+import csv
 import json
+import math
 import re
 import collections
 collections.Callable = collections.abc.Callable
@@ -20,6 +38,10 @@ collections.Callable = collections.abc.Callable
 app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
+init_sessions(app)
+init_profiler(app)
+init_compression(app)
+limiter = init_limiter(app)
 db.init_app(app)
 migrate = Migrate(app, db)
 migrate.init_app(app, db)
@@ -43,6 +65,8 @@ def format_datetime(value, format='medium'):
 
 
 app.jinja_env.filters['datetime'] = format_datetime
+# After the filters, the templates are compiled when the app starts
+init_templates(app)
 
 #----------------------------------------------------------------------------#
 # Controllers.
@@ -55,10 +79,12 @@ def index():
     venues = []
 
     try:
-        recently_listed_artists = Artist.query.order_by(
+        recently_listed_artists = Artist.query.filter(
+            Artist.deleted_at_timestamp.is_(None)).order_by(
             desc(Artist.created_at_timestamp)).limit(10).all()
 
-        recently_listed_venues = Venue.query.order_by(
+        recently_listed_venues = Venue.query.filter(
+            Venue.deleted_at_timestamp.is_(None)).order_by(
             desc(Venue.created_at_timestamp)).limit(10).all()
 
         for artist in recently_listed_artists:
@@ -76,11 +102,13 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@conditional('venue', 'show')
 def venues():
     data = []
     try:
         locations_set = set()
-        venues = Venue.query.distinct(Venue.state, Venue.city).all()
+        venues = Venue.query.filter(Venue.deleted_at_timestamp.is_(None)).distinct(
+            Venue.state, Venue.city).all()
         # Get all states and cities of all venues stored in the database
         for venue in venues:
             locations_set.add((venue.city, venue.state))
@@ -89,7 +117,7 @@ def venues():
 
         for location in locations:
             venues = Venue.query.filter_by(
-                city=location[0], state=location[1]).all()
+                city=location[0], state=location[1], deleted_at_timestamp=None).all()
 
             formated_venues = []
             for venue in venues:
@@ -112,33 +140,84 @@ def venues():
         return render_template('pages/venues.html', areas=data)
 
 
-@app.route('/venues/search', methods=['POST'])
-def search_venues():
-    data = []
-    venues = Venue.query.filter(Venue.name.ilike(r"%{}%".format(
-        request.form.get('search_term')))).all()
-
-    for venue in venues:
-        num_upcoming_shows = 0
-
-        if venue.shows:
-            for show in venue.shows:
-                if datetime.today() < datetime.strptime(show.start_time, "%Y-%m-%d %H:%M:%S"):
-                    num_upcoming_shows += 1
+def find_venues(search_term):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    venues = db.session.query(Venue.id, Venue.name, db.func.count(Show.id)).outerjoin(
+        Show, and_(Show.venue_id == Venue.id, Show.start_time > now)).filter(
+        Venue.name.ilike(r"%{}%".format(search_term)),
+        Venue.deleted_at_timestamp.is_(None)).group_by(
+        Venue.id, Venue.name).all()
 
+    data = []
+    for venue_id, name, num_upcoming_shows in venues:
         data.append({
-            "id": venue.id,
-            "name": venue.name,
+            "id": venue_id,
+            "name": name,
             "num_upcoming_shows": num_upcoming_shows
         })
-    response = {
+    return {
         "count": len(data),
         "data": data
     }
 
+
+@app.route('/venues/search', methods=['POST'])
+@limit('search')
+def search_venues():
+    response = search_cache.get_or_compute(
+        'venues', request.form.get('search_term', ''), find_venues)
+
     return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
 
 
+@app.route('/venues/nearby')
+def nearby_venues():
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None:
+        centroid = geocoder.geocode(
+            request.args.get('city'), request.args.get('state'))
+        if centroid is None:
+            return jsonify({"error": "Provide lat and lon, or a known city and state."}), 400
+        latitude, longitude = centroid
+    if not (math.isfinite(latitude) and math.isfinite(longitude)
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({"error": "lat must be within [-90, 90] and lon within [-180, 180]."}), 400
+
+    upcoming_only = request.args.get('upcoming', '0') in ('1', 'true')
+    k = request.args.get('k', type=int)
+    if k is not None:
+        matches = venue_grid.nearest(latitude, longitude, k, upcoming_only)
+    else:
+        radius = request.args.get('radius', 25, type=float)
+        if not (math.isfinite(radius) and 0 < radius <= MAX_RADIUS_MILES):
+            return jsonify({"error": f"radius must be a number of miles in (0, {MAX_RADIUS_MILES:.0f}]."}), 400
+        matches = venue_grid.within(latitude, longitude, radius, upcoming_only)
+
+    return jsonify({
+        "latitude": latitude,
+        "longitude": longitude,
+        "venues": [{"id": venue_id, "distance_miles": round(distance, 2)}
+                   for distance, venue_id in matches]
+    })
+
+
+@app.cli.command('geocode-venues')
+def geocode_venues():
+    """Fill Venue.latitude/longitude from the offline city centroids."""
+    geocoded = 0
+    for venue in Venue.query.filter(Venue.latitude.is_(None)).all():
+        centroid = geocoder.geocode(venue.city, venue.state)
+        if centroid is not None:
+            venue.latitude, venue.longitude = centroid
+            record_change('venue', venue.id, 'updated', {
+                "latitude": venue.latitude, "longitude": venue.longitude})
+            geocoded += 1
+    db.session.commit()
+    notify_consumers()
+    print(f"Geocoded {geocoded} venues")
+
+
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
     data = {}
@@ -146,25 +225,24 @@ def show_venue(venue_id):
         venue = Venue.query.get(venue_id)
         venue_upcoming_shows = []
         venue_past_shows = []
-
-        shows_query = db.session.query(Show).join(
-            Venue).filter(Show.venue_id == venue_id).all()
-
-        for show in shows_query:
+        full_history = request.args.get('history') == 'full'
+
+        shows_query = db.session.query(Show, Artist).join(
+            Artist, Artist.id == Show.artist_id).filter(Show.venue_id == venue_id).all()
+        if full_history:
+            shows_query += archived_shows(venue_id=venue_id)
+
+        for show, artist in shows_query:
+            formated_show = {
+                "artist_id": show.artist_id,
+                "artist_name": artist.name,
+                "artist_image_link": artist.image_link,
+                "start_time": show.start_time
+            }
             if datetime.strptime(show.start_time, "%Y-%m-%d %H:%M:%S") > datetime.now():
-                venue_upcoming_shows.append({
-                    "artist_id": show.artist_id,
-                    "artist_name": show.Artist.name,
-                    "artist_image_link": show.Artist.image_link,
-                    "start_time": show.start_time
-                })
+                venue_upcoming_shows.append(formated_show)
             else:
-                venue_upcoming_shows.append({
-                    "artist_id": show.artist_id,
-                    "artist_name": show.Artist.name,
-                    "artist_image_link": show.Artist.image_link,
-                    "start_time": show.start_time
-                })
+                venue_past_shows.append(formated_show)
 
         data = {
             "id": venue.id,
@@ -183,6 +261,7 @@ def show_venue(venue_id):
             "upcoming_shows": venue_upcoming_shows,
             "past_shows_count": len(venue_past_shows),
             "upcoming_shows_count": len(venue_upcoming_shows),
+            "full_history": full_history,
         }
     except Exception as e:
         print(e)
@@ -201,6 +280,7 @@ def create_venue_form():
 
 
 @app.route('/venues/create', methods=['POST'])
+@limit('write')
 def create_venue_submission():
 
     form = VenueForm(data=request.form)
@@ -219,8 +299,17 @@ def create_venue_submission():
             seeking_description=form.seeking_description.data,
             genres=form.genres.data
         )
+        new_venue.latitude, new_venue.longitude = geocoder.geocode(
+            form.city.data, form.state.data) or (None, None)
         db.session.add(new_venue)
+        db.session.flush()
+        record_change('venue', new_venue.id, 'created', snapshot(new_venue))
         db.session.commit()
+        notify_consumers()
+        match_index.refresh_venue(new_venue.id)
+        search_cache.bump('venues')
+        venue_grid.update_venue(
+            new_venue.id, new_venue.latitude, new_venue.longitude)
 
         # on successful db insert, flash success
         flash('Venue ' + request.form['name'] +
@@ -236,19 +325,19 @@ def create_venue_submission():
 
 
 @app.route('/venues/<venue_id>/delete', methods=['GET'])
+@limit('write')
 def delete_venue(venue_id):
     try:
         venue = Venue.query.get(venue_id)
-        shows = Show.query.filter_by(venue_id=venue_id).all()
-
-        if len(shows) > 0:
+        name = venue.name
+        result = bulk_delete('venues', [venue.id])
+        if result["blocked"]:
             flash(
-                f"The venue {venue.name} cannot be deleted, there's at least one Show that depends on this Venue stored in the database")
+                f"The venue {name} cannot be deleted, there's at least one Show that depends on this Venue stored in the database")
             return redirect("index")
-        db.session.delete(venue)
-        db.session.commit()
+        update_indexes_for_deletion('venues', result["deleted"])
         flash(
-            f"The venue {venue.name} has been deleted from the database")
+            f"The venue {name} has been deleted from the database")
     except:
         db.session.rollback()
         flash(
@@ -257,15 +346,90 @@ def delete_venue(venue_id):
         db.session.close()
         return redirect(url_for('index'))
 
+
+def update_indexes_for_deletion(kind, deleted_ids, mode='restrict'):
+    notify_consumers()
+    if kind == 'venues':
+        search_cache.bump('venues')
+        for venue_id in deleted_ids:
+            match_index.remove_venue(venue_id)
+            venue_grid.remove_venue(venue_id)
+    else:
+        search_cache.bump('artists')
+        for artist_id in deleted_ids:
+            match_index.remove_artist(artist_id)
+    if mode == 'cascade' and deleted_ids:
+        # The shows went too: upcoming show counts of the other kind, venue
+        # hours and latest shows. The indexes find those venues in the outbox.
+        search_cache.bump('artists', 'venues')
+        if match_index.built:
+            match_index.sync()
+        if venue_grid.built:
+            venue_grid.sync()
+
+
+@app.route('/<any(artists, venues):kind>/bulk-delete', methods=['POST'])
+@limit('write')
+def bulk_delete_records(kind):
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get("ids") if isinstance(payload, dict) else None
+    if not isinstance(ids, list) or not ids:
+        return jsonify({"error": "Expected a JSON body with a non empty \"ids\" list."}), 400
+    mode = payload.get("mode", "restrict")
+    if mode not in DELETE_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(DELETE_MODES)}."}), 400
+    try:
+        ids = [int(record_id) for record_id in ids]
+        chunk_size = max(1, int(payload.get("chunk_size", 500)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids and chunk_size must be integers."}), 400
+
+    deleted_ids = []
+    try:
+        result = bulk_delete(kind, ids, mode, chunk_size,
+                             progress=lambda done, total, chunk: deleted_ids.extend(chunk))
+    except Exception:
+        # Chunks committed before the failure stay deleted
+        update_indexes_for_deletion(kind, deleted_ids, mode)
+        return jsonify({"error": "The deletion stopped, the database might not be running.",
+                        "deleted": deleted_ids}), 500
+    update_indexes_for_deletion(kind, result["deleted"], mode)
+    return jsonify(dict(result, mode=mode))
+
+
+@app.cli.command('bulk-delete')
+@click.argument('kind', type=click.Choice(['artists', 'venues']))
+@click.argument('ids_file', type=click.File())
+@click.option('--mode', type=click.Choice(DELETE_MODES), default='restrict', show_default=True)
+@click.option('--chunk-size', default=500, show_default=True)
+def bulk_delete_command(kind, ids_file, mode, chunk_size):
+    """Delete the artists or venues whose ids are listed in a file, one per line."""
+    ids = [line.strip() for line in ids_file if line.strip()]
+    deleted_ids = []
+
+    def progress(done, total, chunk):
+        deleted_ids.extend(chunk)
+        print(f"Deleted {done}/{total} {kind}...")
+    try:
+        result = bulk_delete(kind, ids, mode, chunk_size, progress)
+    finally:
+        update_indexes_for_deletion(kind, deleted_ids, mode)
+    for record_id in result["blocked"]:
+        print(f"{kind[:-1]} {record_id}: has shows, not deleted")
+    print(f"Done, {len(result['deleted'])} deleted, {len(result['blocked'])} blocked, "
+          f"{len(result['missing'])} not found")
+
+
 #  Artists
 #  ----------------------------------------------------------------
 
 
 @app.route('/artists')
+@conditional('artist')
 def artists():
     data = []
     try:
-        artists = Artist.query.all()
+        artists = Artist.query.filter(Artist.deleted_at_timestamp.is_(None)).all()
         for artist in artists:
             data.append({
                 "id": artist.id,
@@ -277,32 +441,50 @@ def artists():
         return render_template('pages/artists.html', artists=data)
 
 
-@app.route('/artists/search', methods=['POST'])
-def search_artists():
-    data = []
-    artists = Artist.query.filter(Artist.name.ilike(r"%{}%".format(
-        request.form.get('search_term')))).all()
-
-    for artist in artists:
-        num_upcoming_shows = 0
-
-        if artist.shows:
-            for show in artist.shows:
-                if datetime.today() < datetime.strptime(show.start_time, "%Y-%m-%d %H:%M:%S"):
-                    num_upcoming_shows += 1
+def find_artists(search_term):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    artists = db.session.query(Artist.id, Artist.name, db.func.count(Show.id)).outerjoin(
+        Show, and_(Show.artist_id == Artist.id, Show.start_time > now)).filter(
+        Artist.name.ilike(r"%{}%".format(search_term)),
+        Artist.deleted_at_timestamp.is_(None)).group_by(
+        Artist.id, Artist.name).all()
 
+    data = []
+    for artist_id, name, num_upcoming_shows in artists:
         data.append({
-            "id": artist.id,
-            "name": artist.name,
+            "id": artist_id,
+            "name": name,
             "num_upcoming_shows": num_upcoming_shows
         })
-    response = {
+    return {
         "count": len(data),
         "data": data
     }
+
+
+@app.route('/artists/search', methods=['POST'])
+@limit('search')
+def search_artists():
+    response = search_cache.get_or_compute(
+        'artists', request.form.get('search_term', ''), find_artists)
     return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
 
 
+@app.route('/_metrics/ratelimit')
+def ratelimit_metrics():
+    return jsonify(limiter.statistics() if limiter is not None else {})
+
+
+@app.route('/_metrics/templates')
+def template_metrics():
+    return jsonify(render_metrics.statistics())
+
+
+@app.route('/search/cache-stats')
+def search_cache_stats():
+    return jsonify(search_cache.statistics())
+
+
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
     data = {}
@@ -310,24 +492,24 @@ def show_artist(artist_id):
         artist = Artist.query.get(artist_id)
         artist_upcoming_shows = []
         artist_past_shows = []
-
-        if artist.shows:
-            for show in artist.shows:
-                venue = show.Venue
-                if datetime.today() < datetime.strptime(show.start_time, "%Y-%m-%d %H:%M:%S"):
-                    artist_upcoming_shows.append({
-                        "venue_id": venue.id,
-                        "venue_name": venue.name,
-                        "venue_image_link": venue.image_link,
-                        "start_time": show.start_time
-                    })
-                else:
-                    artist_past_shows.append({
-                        "venue_id": venue.id,
-                        "venue_name": venue.name,
-                        "venue_image_link": venue.image_link,
-                        "start_time": show.start_time
-                    })
+        full_history = request.args.get('history') == 'full'
+
+        shows_query = db.session.query(Show, Venue).join(
+            Venue, Venue.id == Show.venue_id).filter(Show.artist_id == artist_id).all()
+        if full_history:
+            shows_query += archived_shows(artist_id=artist_id)
+
+        for show, venue in shows_query:
+            formated_show = {
+                "venue_id": venue.id,
+                "venue_name": venue.name,
+                "venue_image_link": venue.image_link,
+                "start_time": show.start_time
+            }
+            if datetime.today() < datetime.strptime(show.start_time, "%Y-%m-%d %H:%M:%S"):
+                artist_upcoming_shows.append(formated_show)
+            else:
+                artist_past_shows.append(formated_show)
         data = {
             "id": artist.id,
             "name": artist.name,
@@ -344,6 +526,7 @@ def show_artist(artist_id):
             "upcoming_shows": artist_upcoming_shows,
             "past_shows_count": len(artist_past_shows),
             "upcoming_shows_count": len(artist_upcoming_shows),
+            "full_history": full_history,
         }
     except:
         flash(
@@ -352,6 +535,31 @@ def show_artist(artist_id):
 
     return render_template('pages/show_artist.html', artist=data)
 
+#  Matching
+#  ----------------------------------------------------------------
+
+
+@app.route('/artists/<int:artist_id>/matches')
+def artist_matches(artist_id):
+    limit = request.args.get('limit', 10, type=int)
+    if Artist.query.get(artist_id) is None:
+        abort(404)
+    return jsonify({
+        "artist_id": artist_id,
+        "venues": match_index.venues_for_artist(artist_id, limit)
+    })
+
+
+@app.route('/venues/<int:venue_id>/matches')
+def venue_matches(venue_id):
+    limit = request.args.get('limit', 10, type=int)
+    if Venue.query.get(venue_id) is None:
+        abort(404)
+    return jsonify({
+        "venue_id": venue_id,
+        "artists": match_index.artists_for_venue(venue_id, limit)
+    })
+
 #  Update
 #  ----------------------------------------------------------------
 
@@ -367,6 +575,7 @@ def edit_artist(artist_id):
                 "state": artist.state,
                 "phone": artist.phone,
                 "website": artist.website_link,
+                "website_link": artist.website_link,
                 "facebook_link": artist.facebook_link,
                 "seeking_venue": artist.seeking_venue,
                 "seeking_description": artist.seeking_description,
@@ -383,23 +592,37 @@ def edit_artist(artist_id):
 
 
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
+@limit('write')
 def edit_artist_submission(artist_id):
     form = ArtistForm(request.form)
     form.genres.data = json.dumps(request.form.getlist("genres"))
     form.availability_hours_24_format.data = json.dumps(
         request.form.getlist("availability_hours_24_format"))
     try:
-        db.session.query(Artist).filter(
-            Artist.id == artist_id).update(
-            form.data
-        )
+        changes = compare_and_swap(
+            Artist, artist_id, request.form.get('version', type=int), form.data)
+        if changes:
+            record_change('artist', artist_id, 'updated', changes)
         db.session.commit()
+        if changes:
+            notify_consumers()
+            match_index.refresh_artist(artist_id)
+            search_cache.bump('artists')
         return redirect(url_for('show_artist', artist_id=artist_id))
+    except EditConflict:
+        db.session.rollback()
+        artist = Artist.query.get(artist_id)
+        if artist is None or artist.deleted_at_timestamp is not None:
+            flash(f"The artist {form.name.data} has been deleted.")
+            return redirect(url_for('index'))
+        flash(f"The artist {artist.name} was modified by someone else while you were editing it. "
+              "Review your changes and save again to overwrite theirs.")
+        return render_template('forms/edit_artist.html', form=form, artist=artist), 409
     except:
         db.session.rollback()
         flash(f"Failed to update the artist {form.name.data}")
     finally:
-        db.session.close
+        db.session.close()
     return redirect(url_for('index'))
 
 
@@ -415,6 +638,7 @@ def edit_venue(venue_id):
                 "state": venue.state,
                 "phone": venue.phone,
                 "website": venue.website_link,
+                "website_link": venue.website_link,
                 "facebook_link": venue.facebook_link,
                 "seeking_talent": venue.seeking_talent,
                 "seeking_description": venue.seeking_description,
@@ -430,22 +654,44 @@ def edit_venue(venue_id):
 
 
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
+@limit('write')
 def edit_venue_submission(venue_id):
     form = VenueForm(request.form)
     form.genres.data = json.dumps(request.form.getlist('genres'))
+    data = form.data
+    data["latitude"], data["longitude"] = geocoder.geocode(
+        form.city.data, form.state.data) or (None, None)
     try:
-        db.session.query(Venue).filter(
-            Venue.id == venue_id).update(
-            form.data
-        )
+        changes = compare_and_swap(
+            Venue, venue_id, request.form.get('version', type=int), data)
+        if changes:
+            record_change('venue', venue_id, 'updated', changes)
         db.session.commit()
+        if changes:
+            notify_consumers()
+            match_index.refresh_venue(venue_id)
+            search_cache.bump('venues')
+            venue_grid.update_venue(
+                venue_id, data["latitude"], data["longitude"])
+    except EditConflict:
+        db.session.rollback()
+        venue = Venue.query.get(venue_id)
+        if venue is None or venue.deleted_at_timestamp is not None:
+            flash(f"The venue {form.name.data} has been deleted.")
+            db.session.close()
+            return redirect(url_for('index'))
+        flash(f"The venue {venue.name} was modified by someone else while you were editing it. "
+              "Review your changes and save again to overwrite theirs.")
+        response = render_template(
+            'forms/edit_venue.html', form=form, venue=venue), 409
         db.session.close()
-        redirect(url_for('show_venue', venue_id=venue_id))
+        return response
     except:
         db.session.rollback()
         flash(f"Could not update the venue {form.name.data}")
         db.session.close()
         return redirect(url_for('index'))
+    db.session.close()
     return redirect(url_for('show_venue', venue_id=venue_id))
 
 #  Create Artist
@@ -459,6 +705,7 @@ def create_artist_form():
 
 
 @app.route('/artists/create', methods=['POST'])
+@limit('write')
 def create_artist_submission():
 
     form = ArtistForm(data=request.form)
@@ -500,7 +747,12 @@ def create_artist_submission():
         )
 
         db.session.add(artist)
+        db.session.flush()
+        record_change('artist', artist.id, 'created', snapshot(artist))
         db.session.commit()
+        notify_consumers()
+        match_index.refresh_artist(artist.id)
+        search_cache.bump('artists')
         flash('Artist ' + request.form['name'] + ' was successfully listed!')
     except:
         flash('An error occurred. Artist ' +
@@ -515,17 +767,22 @@ def create_artist_submission():
 #  ----------------------------------------------------------------
 
 @ app.route('/shows')
+@conditional('show', 'artist', 'venue')
 def shows():
     data = []
     try:
-        shows = Show.query.all()
-        for show in shows:
+        shows = db.session.query(Show, Artist, Venue).join(
+            Artist, Artist.id == Show.artist_id).join(
+            Venue, Venue.id == Show.venue_id).all()
+        if request.args.get('history') == 'full':
+            shows = all_archived_shows() + shows
+        for show, artist, venue in shows:
             data.append({
                 "venue_id": show.venue_id,
-                "venue_name": show.Venue.name,
-                "artist_id": show.Artist.id,
-                "artist_name": show.Artist.name,
-                "artist_image_link": show.Artist.image_link,
+                "venue_name": venue.name,
+                "artist_id": artist.id,
+                "artist_name": artist.name,
+                "artist_image_link": artist.image_link,
                 "start_time": show.start_time
             })
     except:
@@ -542,11 +799,19 @@ def create_shows():
 
 
 @ app.route('/shows/create', methods=['POST'])
+@limit('write')
 def create_show_submission():
     form = ShowForm(request.form)
     try:
-        # Check if artist is available by the time chose
+        # Soft deleted artists and venues can't be booked anymore
         artist = Artist.query.get(form.artist_id.data)
+        venue = Venue.query.get(form.venue_id.data)
+        for record, kind in ((artist, 'artist'), (venue, 'venue')):
+            if record is not None and record.deleted_at_timestamp is not None:
+                flash(f"The {kind} {record.name} has been deleted.")
+                return redirect(url_for('create_shows'))
+
+        # Check if artist is available by the time chose
         for hour in json.loads(artist.availability_hours_24_format):
             if int(hour) == form.start_time.data.hour:
                 flash(
@@ -559,7 +824,14 @@ def create_show_submission():
             start_time=form.start_time.data
         )
         db.session.add(new_show)
+        db.session.flush()
+        record_change('show', new_show.id, 'created', snapshot(new_show))
+        analytics.record_shows([snapshot(new_show)])
         db.session.commit()
+        notify_consumers()
+        match_index.refresh_venue(new_show.venue_id)
+        search_cache.bump('artists', 'venues')
+        venue_grid.add_show(new_show.venue_id, new_show.start_time)
         flash('Show was successfully listed!')
     except:
         db.session.rollback()
@@ -570,6 +842,130 @@ def create_show_submission():
     return redirect(url_for('index'))
 
 
+def update_indexes_for_shows(created_shows):
+    notify_consumers()
+    search_cache.bump('artists', 'venues')
+    for show in created_shows:
+        venue_grid.add_show(show["venue_id"], show["start_time"])
+    for venue_id in {show["venue_id"] for show in created_shows}:
+        match_index.refresh_venue(venue_id)
+
+
+@ app.route('/shows/batch', methods=['POST'])
+@limit('write')
+def create_shows_batch():
+    payload = request.get_json(silent=True) or {}
+    rows = payload.get("shows") if isinstance(payload, dict) else None
+    if not isinstance(rows, list) or not rows:
+        return jsonify({"error": "Expected a JSON body with a non empty \"shows\" list."}), 400
+
+    try:
+        created_shows, rejections = schedule_shows(rows)
+    except Exception:
+        return jsonify({"error": "The shows could not be listed, the database might not be running."}), 500
+
+    if rejections:
+        return jsonify({"accepted": False, "created": 0, "rejections": rejections}), 409
+    update_indexes_for_shows(created_shows)
+    return jsonify({"accepted": True, "created": len(created_shows), "shows": created_shows}), 201
+
+
+@app.cli.command('schedule-tour')
+@click.argument('tour_file', type=click.File())
+def schedule_tour(tour_file):
+    """List every show of a CSV file (artist_id,venue_id,start_time) at once."""
+    created_shows, rejections = schedule_shows(list(csv.DictReader(tour_file)))
+    for rejection in rejections:
+        # Report the line of the file, the header being line 1
+        print(f"line {rejection['row'] + 2}: {rejection['reason']}")
+    if rejections:
+        raise click.ClickException(
+            f"Tour rejected, {len(rejections)} show(s) could not be listed")
+    update_indexes_for_shows(created_shows)
+    print(f"Listed {len(created_shows)} shows")
+
+
+@app.cli.command('archive-shows')
+@click.option('--older-than-days', default=365, show_default=True,
+              help='Archive the shows that started more than this many days ago.')
+@click.option('--batch-size', default=1000, show_default=True)
+def archive_shows_command(older_than_days, batch_size):
+    """Move old shows from Show to ShowArchive in batches."""
+    moved = archive_shows(older_than_days, batch_size,
+                          progress=lambda moved: print(f"Archived {moved} shows..."))
+    print(f"Done, {moved} shows archived")
+
+
+#  Analytics
+#  ----------------------------------------------------------------
+
+@app.route('/analytics/venues/<int:venue_id>/monthly')
+def analytics_venue_monthly(venue_id):
+    months = request.args.get('months', 12, type=int)
+    return jsonify({"venue_id": venue_id,
+                    "months": analytics.venue_monthly_shows(venue_id, months)})
+
+
+@app.route('/analytics/cities')
+def analytics_cities():
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify({"cities": analytics.busiest_cities(limit)})
+
+
+@app.route('/analytics/genres')
+def analytics_genres():
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify({"genres": analytics.top_genres(limit)})
+
+
+@app.route('/analytics/artists')
+def analytics_artists():
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify({"artists": analytics.most_booked_artists(limit)})
+
+
+@app.cli.command('backfill-analytics')
+@click.option('--chunk-size', default=5000, show_default=True)
+def backfill_analytics(chunk_size):
+    """Rebuild the analytics rollups from every show, archived ones included."""
+    processed = analytics.backfill(
+        chunk_size, progress=lambda processed: print(f"Processed {processed} shows..."))
+    print(f"Done, {processed} shows processed")
+
+
+#  Sitemaps
+#  ----------------------------------------------------------------
+
+@app.route('/sitemap.xml')
+def sitemap_index():
+    return sitemap.sitemap_index()
+
+
+@app.route('/sitemaps/<any(artists, venues):kind>-<int:shard>.xml')
+def sitemap_shard(kind, shard):
+    return sitemap.sitemap_shard(kind, shard)
+
+
+#  Change feed
+#  ----------------------------------------------------------------
+
+@app.route('/changes')
+def changes():
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    wait = request.args.get('wait', 0, type=float)
+    if not math.isfinite(wait):
+        return jsonify({"error": "wait must be a finite number of seconds."}), 400
+    try:
+        events = wait_for_changes(after, limit, wait)
+    except Exception:
+        return jsonify({"error": "Could not fetch changes, the database might not be running."}), 500
+    return jsonify({
+        "events": events,
+        "next_offset": events[-1]["offset"] if events else after
+    })
+
+
 @ app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from models import db, Artist, Show, ShowArchive, Venue
+from outbox import record_changes
+
+#----------------------------------------------------------------------------#
+# Show archival.
+#----------------------------------------------------------------------------#
+# The Show table only keeps the recent and upcoming shows ("hot" shows), the
+# profile pages and listings read it alone unless the full history is asked
+# for. Older shows are moved in batches to ShowArchive, a table range
+# partitioned by year on Postgres.
+
+START_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def ensure_partitions(years):
+    '''Create the yearly ShowArchive partitions (Postgres only).'''
+    if not _postgresql():
+        return
+    db.session.execute(text(
+        'CREATE TABLE IF NOT EXISTS "ShowArchive_default" '
+        'PARTITION OF "ShowArchive" DEFAULT'))
+    for year in sorted(years):
+        db.session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "ShowArchive_{year:04d}" '
+            f'PARTITION OF "ShowArchive" '
+            f"FOR VALUES FROM ('{year:04d}') TO ('{year + 1:04d}')"))
+
+
+def archive_shows(older_than_days=365, batch_size=1000, progress=None):
+    '''Move the shows that started more than older_than_days ago to the
+    archive, one transaction per batch. Returns the number of shows moved.'''
+    cutoff = (datetime.now() - timedelta(days=older_than_days)
+              ).strftime(START_TIME_FORMAT)
+    moved = 0
+    while True:
+        shows = db.session.query(
+            Show.id, Show.artist_id, Show.venue_id, Show.start_time).filter(
+            Show.start_time < cutoff).order_by(Show.id).limit(batch_size).all()
+        if not shows:
+            break
+        rows = [{"id": show_id, "artist_id": artist_id,
+                 "venue_id": venue_id, "start_time": start_time}
+                for show_id, artist_id, venue_id, start_time in shows]
+        try:
+            years = set()
+            for row in rows:
+                try:
+                    years.add(int(row["start_time"][:4]))
+                except ValueError:
+                    pass
+            ensure_partitions(years)
+            db.session.bulk_insert_mappings(ShowArchive, rows)
+            db.session.query(Show).filter(Show.id.in_(
+                [row["id"] for row in rows])).delete(synchronize_session=False)
+            record_changes([('show', row["id"], 'archived', row)
+                            for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(rows)
+        if progress is not None:
+            progress(moved)
+    return moved
+
+
+def archived_shows(artist_id=None, venue_id=None):
+    '''Archived shows of an artist or a venue, with the other side loaded.'''
+    if artist_id is not None:
+        return db.session.query(ShowArchive, Venue).join(
+            Venue, Venue.id == ShowArchive.venue_id).filter(
+            ShowArchive.artist_id == artist_id).order_by(
+            ShowArchive.start_time).all()
+    return db.session.query(ShowArchive, Artist).join(
+        Artist, Artist.id == ShowArchive.artist_id).filter(
+        ShowArchive.venue_id == venue_id).order_by(
+        ShowArchive.start_time).all()
+
+
+def all_archived_shows():
+    return db.session.query(ShowArchive, Artist, Venue).join(
+        Artist, Artist.id == ShowArchive.artist_id).join(
+        Venue, Venue.id == ShowArchive.venue_id).order_by(
+        ShowArchive.start_time).all()
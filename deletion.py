@@ -0,0 +1,123 @@
+from datetime import datetime
+
+from sqlalchemy import exists, or_
+
+import analytics
+from models import db, Artist, Show, ShowArchive, Venue
+from outbox import record_changes
+
+#----------------------------------------------------------------------------#
+# Bulk deletion of artists and venues.
+#----------------------------------------------------------------------------#
+# Modes:
+#   restrict  delete the records without any show (listed or archived), keep
+#             and report the others.
+#   cascade   delete the records and every show that depends on them, taking
+#             the shows out of the analytics rollups too.
+#   soft      mark the records deleted (deleted_at_timestamp), their shows and
+#             history are kept but they are hidden from listings and search.
+
+MODES = ('restrict', 'cascade', 'soft')
+
+KINDS = {
+    'artists': (Artist, 'artist', 'artist_id'),
+    'venues': (Venue, 'venue', 'venue_id'),
+}
+
+
+def _chunks(ids, size):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def bulk_delete(kind, ids, mode='restrict', chunk_size=500, progress=None):
+    '''Delete the artists or venues with the given ids, one transaction per
+    chunk_size records. Returns {"deleted", "blocked", "missing"} id lists,
+    already soft deleted records count as missing in soft mode.
+
+    Which records exist and which have shows is found by a single query over
+    the whole id set before anything is deleted, and checked again for each
+    chunk in the transaction deleting it. progress(done, total, chunk) is
+    called after each committed chunk.
+    '''
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    model, entity, foreign_key = KINDS[kind]
+    ids = sorted({int(record_id) for record_id in ids})
+    if not ids:
+        return {"deleted": [], "blocked": [], "missing": []}
+
+    has_shows = or_(
+        exists().where(getattr(Show, foreign_key) == model.id),
+        exists().where(getattr(ShowArchive, foreign_key) == model.id))
+    query = db.session.query(model.id, has_shows).filter(model.id.in_(ids))
+    if mode == 'soft':
+        # Soft deleting twice is a no op, count those as gone already
+        query = query.filter(model.deleted_at_timestamp.is_(None))
+    found = {record_id: bool(blocked) for record_id, blocked in query}
+
+    missing = [record_id for record_id in ids if record_id not in found]
+    if mode == 'restrict':
+        blocked = [record_id for record_id, dependent in sorted(found.items()) if dependent]
+        targets = [record_id for record_id, dependent in sorted(found.items()) if not dependent]
+    else:
+        blocked = []
+        targets = sorted(found)
+
+    deleted = []
+    done = 0
+    for chunk in _chunks(targets, chunk_size):
+        try:
+            # Check again at delete time, with the rows locked: a show may
+            # have been booked, or a record deleted, since the check above
+            current = query.filter(model.id.in_(chunk)).with_for_update()
+            rows = dict(current)
+            missing.extend(record_id for record_id in chunk if record_id not in rows)
+            if mode == 'restrict':
+                blocked.extend(record_id for record_id, dependent in rows.items() if dependent)
+                chunk = sorted(record_id for record_id, dependent in rows.items() if not dependent)
+            else:
+                chunk = sorted(rows)
+
+            if mode == 'soft':
+                db.session.query(model).filter(
+                    model.id.in_(chunk), model.deleted_at_timestamp.is_(None)).update(
+                    {"deleted_at_timestamp": datetime.timestamp(datetime.now()),
+                     "version": model.version + 1}, synchronize_session=False)
+                record_changes([(entity, record_id, 'soft_deleted', None)
+                                for record_id in chunk])
+            else:
+                if mode == 'cascade':
+                    _delete_shows(foreign_key, chunk)
+                delete = db.session.query(model).filter(model.id.in_(chunk))
+                if mode == 'restrict':
+                    delete = delete.filter(~has_shows)
+                delete.delete(synchronize_session=False)
+                record_changes([(entity, record_id, 'deleted', None)
+                                for record_id in chunk])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        deleted.extend(chunk)
+        done += chunk_size
+        if progress is not None:
+            progress(min(done, len(targets)), len(targets), chunk)
+
+    return {"deleted": deleted, "blocked": sorted(blocked), "missing": sorted(missing)}
+
+
+def _delete_shows(foreign_key, record_ids):
+    deleted = []
+    for model in (Show, ShowArchive):
+        column = getattr(model, foreign_key)
+        deleted += [{"id": show_id, "artist_id": artist_id, "venue_id": venue_id,
+                     "start_time": start_time}
+                    for show_id, artist_id, venue_id, start_time in db.session.query(
+                        model.id, model.artist_id, model.venue_id, model.start_time).filter(
+                        column.in_(record_ids))]
+        db.session.query(model).filter(column.in_(record_ids)).delete(
+            synchronize_session=False)
+    analytics.forget_shows(deleted)
+    # The payload tells the outbox followers which venues lost shows
+    record_changes([('show', show["id"], 'deleted', show) for show in deleted])
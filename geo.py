@@ -0,0 +1,294 @@
+import csv
+import heapq
+import math
+import os
+import threading
+from datetime import datetime
+
+from models import db, Show, Venue
+from outbox import changed_records, latest_offset, rebuild_in_background
+
+#----------------------------------------------------------------------------#
+# Offline geocoding and venue spatial index.
+#----------------------------------------------------------------------------#
+
+CENTROIDS_PATH = os.path.join(os.path.abspath(
+    os.path.dirname(__file__)), 'data', 'city_centroids.csv')
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+# Size of a grid cell in degrees, roughly 35 miles of latitude
+CELL_SIZE = 0.5
+GRID_COLUMNS = int(360 / CELL_SIZE)
+MIN_ROW = int(math.floor(-90 / CELL_SIZE))
+MAX_ROW = int(math.floor(90 / CELL_SIZE))
+# Half the circumference, every point of the globe is within it
+MAX_RADIUS_MILES = math.pi * EARTH_RADIUS_MILES
+
+
+def _normalize(value):
+    return ' '.join((value or '').split()).casefold()
+
+
+class Geocoder:
+    '''Resolves a (city, state) pair to the centroid shipped in
+    data/city_centroids.csv. No network call is ever made.'''
+
+    def __init__(self, path=CENTROIDS_PATH):
+        self.path = path
+        self.centroids = None
+
+    def load(self):
+        centroids = {}
+        if os.path.exists(self.path):
+            with open(self.path, newline='') as centroids_file:
+                for row in csv.DictReader(centroids_file):
+                    centroids[(_normalize(row['city']), _normalize(row['state']))] = (
+                        float(row['latitude']), float(row['longitude']))
+        self.centroids = centroids
+
+    def geocode(self, city, state):
+        if self.centroids is None:
+            self.load()
+        return self.centroids.get((_normalize(city), _normalize(state)))
+
+
+geocoder = Geocoder()
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+def _wrap_column(column):
+    # Columns west of -180 and east of 180 are the same meridians again
+    return (column + GRID_COLUMNS // 2) % GRID_COLUMNS - GRID_COLUMNS // 2
+
+
+def _cell(latitude, longitude):
+    return (int(math.floor(latitude / CELL_SIZE)),
+            _wrap_column(int(math.floor(longitude / CELL_SIZE))))
+
+
+class VenueGrid:
+    '''Fixed size lat/lon grid over every geocoded venue.
+
+    Each venue also keeps the start time of its latest show so that
+    "upcoming shows only" queries never have to touch the Show table.
+    '''
+
+    def __init__(self):
+        self.cells = {}
+        self.venues = {}
+        self.last_show = {}
+        self.lock = threading.Lock()
+        self.built = False
+        self.rebuilding = False
+        # Last outbox event reflected in the grid
+        self.offset = 0
+
+    def build(self):
+        # Read first, changes committed while building are applied again
+        offset = latest_offset()
+        last_show = dict(db.session.query(
+            Show.venue_id, db.func.max(Show.start_time)).group_by(Show.venue_id))
+        venues = db.session.query(
+            Venue.id, Venue.latitude, Venue.longitude).filter(
+            Venue.latitude.isnot(None), Venue.longitude.isnot(None),
+            Venue.deleted_at_timestamp.is_(None)).all()
+        # Built aside and swapped in, queries keep using the old grid
+        cells = {}
+        positions = {}
+        for venue_id, latitude, longitude in venues:
+            positions[venue_id] = (latitude, longitude)
+            cells.setdefault(_cell(latitude, longitude), set()).add(venue_id)
+        with self.lock:
+            self.cells = cells
+            self.venues = positions
+            self.last_show = last_show
+            self.offset = offset
+            self.built = True
+
+    def sync(self):
+        '''Build the grid, or catch up with the changes committed since by
+        any process (other workers, CLI commands) from the outbox.'''
+        if not self.built:
+            self.build()
+            return
+        changes = changed_records(self.offset)
+        if changes is None:
+            # Too far behind, answer from the current state while rebuilding
+            rebuild_in_background(self)
+            return
+        offset, _, venue_ids = changes
+        if venue_ids:
+            positions = {venue_id: (latitude, longitude)
+                         for venue_id, latitude, longitude in db.session.query(
+                             Venue.id, Venue.latitude, Venue.longitude).filter(
+                             Venue.id.in_(venue_ids),
+                             Venue.deleted_at_timestamp.is_(None))}
+            last_show = dict(db.session.query(
+                Show.venue_id, db.func.max(Show.start_time)).filter(
+                Show.venue_id.in_(venue_ids)).group_by(Show.venue_id))
+        with self.lock:
+            for venue_id in venue_ids:
+                self._remove(venue_id)
+                latitude, longitude = positions.get(venue_id, (None, None))
+                if latitude is not None and longitude is not None:
+                    self._add(venue_id, latitude, longitude)
+                if venue_id in last_show:
+                    self.last_show[venue_id] = last_show[venue_id]
+                else:
+                    self.last_show.pop(venue_id, None)
+            self.offset = max(self.offset, offset)
+
+    def _add(self, venue_id, latitude, longitude):
+        self.venues[venue_id] = (latitude, longitude)
+        self.cells.setdefault(_cell(latitude, longitude), set()).add(venue_id)
+
+    def _remove(self, venue_id):
+        position = self.venues.pop(venue_id, None)
+        if position is not None:
+            cell = self.cells.get(_cell(*position))
+            if cell is not None:
+                cell.discard(venue_id)
+                if not cell:
+                    del self.cells[_cell(*position)]
+
+    def update_venue(self, venue_id, latitude, longitude):
+        if not self.built:
+            return
+        with self.lock:
+            self._remove(venue_id)
+            if latitude is not None and longitude is not None:
+                self._add(venue_id, latitude, longitude)
+
+    def remove_venue(self, venue_id):
+        with self.lock:
+            self._remove(venue_id)
+            self.last_show.pop(venue_id, None)
+
+    def add_show(self, venue_id, start_time):
+        if not self.built:
+            return
+        start_time = str(start_time)
+        with self.lock:
+            if start_time > self.last_show.get(venue_id, ''):
+                self.last_show[venue_id] = start_time
+
+    def _has_upcoming_show(self, venue_id, now):
+        return self.last_show.get(venue_id, '') > now
+
+    def _ring(self, center, distance):
+        row, column = center
+        if distance == 0:
+            yield center
+            return
+        for i in range(-distance, distance + 1):
+            yield (row - distance, column + i)
+            yield (row + distance, column + i)
+        for i in range(-distance + 1, distance):
+            yield (row + i, column - distance)
+            yield (row + i, column + distance)
+
+    @staticmethod
+    def _columns_per_row(latitude, reach=CELL_SIZE):
+        # A degree of longitude shrinks with the latitude, widen the search
+        return 1 / max(math.cos(math.radians(min(abs(latitude) + reach, 89.0))), 0.01)
+
+    @staticmethod
+    def _outside_bound(latitude, longitude, center, distance):
+        """Lower bound, in miles, of the distance to any cell outside the
+        rings 0..distance around center. None once they cover the globe."""
+        row, column = center
+        # A great circle is never shorter than its change of latitude
+        bounds = []
+        north = (row + distance + 1) * CELL_SIZE
+        if north < 90:
+            bounds.append(math.radians(north - latitude) * EARTH_RADIUS_MILES)
+        south = (row - distance) * CELL_SIZE
+        if south > -90:
+            bounds.append(math.radians(latitude - south) * EARTH_RADIUS_MILES)
+        gap = min((column + distance + 1) * CELL_SIZE - longitude,
+                  longitude - (column - distance) * CELL_SIZE)
+        if gap < 180:
+            # Shortest way to a meridian gap degrees away, over a pole past 90
+            sine = math.cos(math.radians(latitude)) * math.sin(math.radians(min(gap, 90)))
+            bounds.append(math.asin(min(1.0, sine)) * EARTH_RADIUS_MILES)
+        return min(bounds) if bounds else None
+
+    def within(self, latitude, longitude, radius, upcoming_only=False):
+        self.sync()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        radius = min(radius, MAX_RADIUS_MILES)
+        lat_cells = int(math.ceil(radius / MILES_PER_DEGREE_LAT / CELL_SIZE))
+        lon_cells = min(int(math.ceil(lat_cells * self._columns_per_row(
+            latitude, radius / MILES_PER_DEGREE_LAT))), GRID_COLUMNS // 2)
+        row, column = _cell(latitude, longitude)
+        # Rows past the poles hold nothing
+        rows = range(max(row - lat_cells, MIN_ROW), min(row + lat_cells, MAX_ROW) + 1)
+        results = []
+        with self.lock:
+            if len(rows) * (2 * lon_cells + 1) > len(self.cells):
+                # More cells in reach than non empty ones, look at those
+                cells = self.cells.keys()
+            else:
+                cells = {(i, _wrap_column(j)) for i in rows
+                         for j in range(column - lon_cells, column + lon_cells + 1)}
+            for cell in cells:
+                for venue_id in self.cells.get(cell, ()):
+                    if upcoming_only and not self._has_upcoming_show(venue_id, now):
+                        continue
+                    distance = haversine_miles(
+                        latitude, longitude, *self.venues[venue_id])
+                    if distance <= radius:
+                        results.append((distance, venue_id))
+        results.sort()
+        return results
+
+    def nearest(self, latitude, longitude, k, upcoming_only=False):
+        self.sync()
+        if k <= 0:
+            return []
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        center = _cell(latitude, longitude)
+        best = []
+        seen = set()
+        with self.lock:
+            if not self.cells:
+                return []
+            distance = 0
+            while True:
+                # Past the point where a ring has more cells than the grid
+                # has non empty ones, look at every cell left instead
+                exhaustive = 8 * distance > len(self.cells)
+                if exhaustive:
+                    ring = [cell for cell in self.cells if cell not in seen]
+                else:
+                    ring = self._ring(center, distance)
+                for cell in ring:
+                    cell = (cell[0], _wrap_column(cell[1]))
+                    if cell in seen:
+                        continue
+                    seen.add(cell)
+                    for venue_id in self.cells.get(cell, ()):
+                        if upcoming_only and not self._has_upcoming_show(venue_id, now):
+                            continue
+                        miles = haversine_miles(
+                            latitude, longitude, *self.venues[venue_id])
+                        if len(best) < k:
+                            heapq.heappush(best, (-miles, venue_id))
+                        elif miles < -best[0][0]:
+                            heapq.heapreplace(best, (-miles, venue_id))
+                if exhaustive:
+                    break
+                bound = self._outside_bound(latitude, longitude, center, distance)
+                if bound is None or (len(best) == k and -best[0][0] <= bound):
+                    break
+                distance += 1
+        return sorted((-miles, venue_id) for miles, venue_id in best)
+
+venue_grid = VenueGrid()
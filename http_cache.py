@@ -0,0 +1,120 @@
+import gzip
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import func
+
+from models import db, ChangeEvent
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#----------------------------------------------------------------------------#
+# HTTP caching and compression.
+#----------------------------------------------------------------------------#
+
+# Below this size compressing costs more than it saves
+MIN_COMPRESS_SIZE = 500
+
+
+def change_marker(entities):
+    '''Offset and time of the latest change event of the given entities,
+    read from the outbox with one index lookup per entity.'''
+    latest = [db.session.query(func.max(ChangeEvent.id)).filter(
+        ChangeEvent.entity == entity).scalar() for entity in entities]
+    latest = max((offset for offset in latest if offset is not None), default=None)
+    row = None
+    if latest is not None:
+        row = db.session.query(ChangeEvent.id, ChangeEvent.created_at_timestamp).filter(
+            ChangeEvent.id == latest).first()
+    return row if row is not None else (0, None)
+
+
+def _pending_flashes():
+    return bool(session.get('_flashes'))
+
+
+def conditional(*entities):
+    '''Answer 304 from the outbox change marker of entities, without running
+    the view, when the client already has the current version of the page.'''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flash messages are per user, never cache a page showing them
+            if _pending_flashes():
+                response = make_response(view(*args, **kwargs))
+                response.headers['Cache-Control'] = 'private, no-store'
+                return response
+
+            try:
+                offset, changed_at = change_marker(entities)
+            except Exception:
+                return view(*args, **kwargs)
+            query_hash = hashlib.sha1(
+                request.query_string).hexdigest()[:12]
+            etag = f'{request.endpoint}-{query_hash}-{offset}'
+            last_modified = (datetime.fromtimestamp(changed_at, timezone.utc).replace(microsecond=0)
+                             if changed_at is not None else None)
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since and changed_at is not None:
+                # Unrounded: a second change within the same second as the
+                # one the client has must not get a 304
+                fresh = changed_at <= request.if_modified_since.timestamp()
+            else:
+                fresh = False
+
+            if fresh:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            # Weak, the body differs with the content encoding
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = (
+                'public, max-age=0, s-maxage={}, must-revalidate'.format(
+                    current_app.config.get('HTTP_CACHE_SHARED_MAX_AGE', 0)))
+            response.vary.add('Accept-Encoding')
+            return response
+        return wrapper
+    return decorator
+
+
+def _accepted_encodings():
+    accepted = {}
+    for value, quality in request.accept_encodings:
+        accepted[value.lower()] = quality
+    return accepted
+
+
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype != 'text/html'
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    accepted = _accepted_encodings()
+    if brotli is not None and accepted.get('br', 0) > 0:
+        response.set_data(brotli.compress(body, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted.get('gzip', 0) > 0:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
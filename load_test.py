@@ -0,0 +1,142 @@
+'''Multi worker form round trip load test.
+
+Starts several independent worker processes serving the app, then drives
+form round trips where every step lands on a different worker:
+
+    1. GET  /venues/create on worker A
+    2. POST /venues/create on worker B  (flash message written to the session)
+    3. GET  /              on worker C  (flash message must be displayed)
+
+Usage:
+    python load_test.py --workers 4 --round-trips 200 --backend sqlite
+    python load_test.py --backend cookie --no-shared-key   # shows the failure
+'''
+import argparse
+import http.cookiejar
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def serve(port, environ):
+    os.environ.update(environ)
+    sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+    from werkzeug.serving import make_server
+    from app import app
+    app.logger.disabled = True
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/venues/create')
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError(f'worker on port {port} did not start')
+
+
+def round_trip(ports, number):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(jar), NoRedirect)
+    first, second, third = (ports[(number + i) % len(ports)] for i in range(3))
+    name = f'Load test venue {number}'
+    started = time.perf_counter()
+
+    opener.open(f'http://127.0.0.1:{first}/venues/create').read()
+
+    data = urllib.parse.urlencode({
+        'name': name, 'city': 'Oakland', 'state': 'CA',
+        'address': '1 Main St', 'phone': '5555555555', 'genres': 'Jazz',
+        'facebook_link': 'https://facebook.com/fyyur',
+    }).encode()
+    try:
+        opener.open(f'http://127.0.0.1:{second}/venues/create', data)
+    except urllib.error.HTTPError as error:
+        if error.code != 302:
+            return False, f'POST returned {error.code}', time.perf_counter() - started
+
+    home = opener.open(f'http://127.0.0.1:{third}/').read().decode()
+    # The name alone also shows up in the recently listed venues
+    if f'Venue {name} was successfully listed!' not in home:
+        return False, 'flash message lost', time.perf_counter() - started
+
+    return True, None, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--round-trips', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--backend', default='sqlite',
+                        choices=['cookie', 'sqlite', 'redis'])
+    parser.add_argument('--base-port', type=int, default=5100)
+    parser.add_argument('--database-url')
+    parser.add_argument('--no-shared-key', action='store_true',
+                        help='let every worker generate its own secret key')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fyyur-load-')
+    secret_key = None if args.no_shared_key else os.urandom(16).hex()
+    environ = {
+        'FYYUR_SESSION_BACKEND': args.backend,
+        'FYYUR_SESSION_SQLITE_PATH': os.path.join(workdir, 'sessions.sqlite'),
+        'DATABASE_URL': args.database_url or 'sqlite:///' + os.path.join(workdir, 'fyyur.db'),
+        # Every request comes from 127.0.0.1, the write limit would reject most
+        'FYYUR_RATELIMIT_ENABLED': '0',
+    }
+    if secret_key:
+        environ['FYYUR_SECRET_KEY'] = secret_key
+
+    context = multiprocessing.get_context('spawn')
+    ports = [args.base_port + i for i in range(args.workers)]
+    workers = []
+    try:
+        # The first worker creates the tables, start the others once it is up
+        for port in ports:
+            worker = context.Process(target=serve, args=(port, environ), daemon=True)
+            worker.start()
+            workers.append(worker)
+            wait_until_ready(port)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            results = list(executor.map(
+                lambda number: round_trip(ports, number),
+                range(args.round_trips)))
+        elapsed = time.perf_counter() - started
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+    failures = [error for ok, error, _ in results if not ok]
+    latencies = sorted(latency for _, _, latency in results)
+    print(f'backend={args.backend} workers={args.workers} '
+          f'shared_key={bool(secret_key)}')
+    print(f'{len(results) - len(failures)}/{len(results)} round trips succeeded '
+          f'in {elapsed:.2f}s ({len(results) / elapsed:.1f}/s)')
+    print(f'latency p50={statistics.median(latencies) * 1000:.1f}ms '
+          f'p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms')
+    for error in sorted(set(failures)):
+        print(f'  {failures.count(error)} x {error}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
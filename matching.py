@@ -0,0 +1,318 @@
+import json
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from models import db, Artist, Show, Venue
+from outbox import changed_records, latest_offset, rebuild_in_background
+
+#----------------------------------------------------------------------------#
+# Artist <-> Venue matching.
+#----------------------------------------------------------------------------#
+
+# Same genre list as the one offered by ArtistForm / VenueForm
+GENRES = [
+    'Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk',
+    'Funk', 'Hip-Hop', 'Heavy Metal', 'Instrumental', 'Jazz',
+    'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae', 'Rock n Roll', 'Soul',
+    'Other',
+]
+GENRE_BITS = {genre: 1 << i for i, genre in enumerate(GENRES)}
+
+ALL_HOURS = (1 << 24) - 1
+
+GENRE_WEIGHT = 0.6
+STATE_WEIGHT = 0.1
+CITY_WEIGHT = 0.15
+AVAILABILITY_WEIGHT = 0.15
+
+# Number of set bits for every 16 bits integer, used to popcount the masks
+_POPCOUNT_16 = np.array([bin(i).count('1')
+                        for i in range(1 << 16)], dtype=np.uint8)
+
+
+def popcount(values):
+    values = values.astype(np.uint32, copy=False)
+    return (_POPCOUNT_16[values & 0xFFFF].astype(np.int32) +
+            _POPCOUNT_16[values >> 16])
+
+
+def genres_mask(genres):
+    if isinstance(genres, str):
+        try:
+            genres = json.loads(genres)
+        except ValueError:
+            genres = []
+    mask = 0
+    for genre in genres or []:
+        mask |= GENRE_BITS.get(genre, 0)
+    return mask
+
+
+def hours_mask(hours):
+    if isinstance(hours, str):
+        try:
+            hours = json.loads(hours)
+        except ValueError:
+            hours = []
+    mask = 0
+    for hour in hours or []:
+        try:
+            mask |= 1 << (int(hour) % 24)
+        except ValueError:
+            continue
+    return mask
+
+
+def free_hours_mask(availability_hours_24_format):
+    # The hours stored on an artist are the ones the artist can't be booked
+    # at (see create_show_submission), so the free hours are the complement.
+    return ALL_HOURS & ~hours_mask(availability_hours_24_format)
+
+
+class _Table:
+    '''Column oriented storage for one side of the matching (artists or venues).
+
+    Rows are never removed, an artist or a venue that stops seeking (or is
+    deleted) is only flagged as inactive so the row positions stay stable.
+    '''
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.genres = np.zeros(0, dtype=np.uint32)
+        self.states = np.zeros(0, dtype=np.int32)
+        self.cities = np.zeros(0, dtype=np.int32)
+        self.hours = np.zeros(0, dtype=np.uint32)
+        self.active = np.zeros(0, dtype=bool)
+        self.rows = {}
+
+    def load(self, records):
+        size = len(records)
+        self.ids = np.zeros(size, dtype=np.int64)
+        self.genres = np.zeros(size, dtype=np.uint32)
+        self.states = np.zeros(size, dtype=np.int32)
+        self.cities = np.zeros(size, dtype=np.int32)
+        self.hours = np.zeros(size, dtype=np.uint32)
+        self.active = np.zeros(size, dtype=bool)
+        self.rows = {}
+        for row, record in enumerate(records):
+            self.rows[record[0]] = row
+            self._set(row, *record)
+
+    def upsert(self, record_id, genres, state, city, hours, active):
+        row = self.rows.get(record_id)
+        if row is None:
+            row = len(self.ids)
+            self.rows[record_id] = row
+            self.ids = np.append(self.ids, np.int64(record_id))
+            self.genres = np.append(self.genres, np.uint32(0))
+            self.states = np.append(self.states, np.int32(-1))
+            self.cities = np.append(self.cities, np.int32(-1))
+            self.hours = np.append(self.hours, np.uint32(0))
+            self.active = np.append(self.active, False)
+        self._set(row, record_id, genres, state, city, hours, active)
+        return row
+
+    def deactivate(self, record_id):
+        row = self.rows.get(record_id)
+        if row is not None:
+            self.active[row] = False
+
+    def _set(self, row, record_id, genres, state, city, hours, active):
+        self.ids[row] = record_id
+        self.genres[row] = genres
+        self.states[row] = state
+        self.cities[row] = city
+        self.hours[row] = hours
+        self.active[row] = active
+
+
+class MatchIndex:
+    '''In memory index scoring every seeking artist against every seeking venue.
+
+    Scores combine the genre overlap (jaccard index of the genre bitsets),
+    the location (same state, same city) and how well the artist's free
+    hours cover the hours the venue usually books shows at.
+    '''
+
+    def __init__(self):
+        self.artists = _Table()
+        self.venues = _Table()
+        self.locations = {}
+        self.lock = threading.Lock()
+        self.built = False
+        self.rebuilding = False
+        # Last outbox event reflected in the index
+        self.offset = 0
+
+    def location_code(self, value, locations=None):
+        if not value:
+            return -1
+        locations = self.locations if locations is None else locations
+        key = ' '.join(value.split()).casefold()
+        return locations.setdefault(key, len(locations))
+
+    def _artist_record(self, artist, locations=None):
+        return (artist.id, genres_mask(artist.genres),
+                self.location_code(artist.state, locations),
+                self.location_code(artist.city, locations),
+                free_hours_mask(artist.availability_hours_24_format),
+                bool(artist.seeking_venue))
+
+    def _venue_record(self, venue, hours, locations=None):
+        return (venue.id, genres_mask(venue.genres),
+                self.location_code(venue.state, locations),
+                self.location_code(venue.city, locations),
+                hours, bool(venue.seeking_talent))
+
+    def _venue_hours(self, venue_id=None):
+        # start_time is stored as "YYYY-MM-DD HH:MM:SS", let the database
+        # reduce the shows to the distinct (venue, hour) pairs
+        hour = db.func.substr(Show.start_time, 12, 2)
+        query = db.session.query(Show.venue_id, hour)
+        if venue_id is not None:
+            query = query.filter(Show.venue_id == venue_id)
+        booked_hours = {}
+        for show_venue_id, show_hour in query.group_by(Show.venue_id, hour):
+            try:
+                booked_hours[show_venue_id] = booked_hours.get(
+                    show_venue_id, 0) | (1 << (int(show_hour) % 24))
+            except (TypeError, ValueError):
+                continue
+        return booked_hours
+
+    def build(self):
+        # Read first, changes committed while building are applied again
+        offset = latest_offset()
+        booked_hours = self._venue_hours()
+        # Built aside and swapped in, queries keep using the old tables
+        locations = {}
+        artists = _Table()
+        artists.load([self._artist_record(artist, locations)
+                      for artist in Artist.query.filter(
+                          Artist.deleted_at_timestamp.is_(None))])
+        venues = _Table()
+        venues.load([self._venue_record(venue, booked_hours.get(venue.id, 0), locations)
+                     for venue in Venue.query.filter(
+                         Venue.deleted_at_timestamp.is_(None))])
+        with self.lock:
+            self.locations = locations
+            self.artists = artists
+            self.venues = venues
+            self.offset = offset
+            self.built = True
+
+    def sync(self):
+        '''Build the index, or catch up with the changes committed since by
+        any process (other workers, CLI commands) from the outbox.'''
+        if not self.built:
+            self.build()
+            return
+        changes = changed_records(self.offset)
+        if changes is None:
+            # Too far behind, answer from the current state while rebuilding
+            rebuild_in_background(self)
+            return
+        offset, artist_ids, venue_ids = changes
+        for artist_id in artist_ids:
+            self.refresh_artist(artist_id)
+        for venue_id in venue_ids:
+            self.refresh_venue(venue_id)
+        with self.lock:
+            self.offset = max(self.offset, offset)
+
+    def refresh_artist(self, artist_id):
+        if not self.built:
+            return
+        artist = Artist.query.get(artist_id)
+        with self.lock:
+            if artist is None or artist.deleted_at_timestamp is not None:
+                self.artists.deactivate(artist_id)
+            else:
+                self.artists.upsert(*self._artist_record(artist))
+
+    def refresh_venue(self, venue_id):
+        if not self.built:
+            return
+        venue = Venue.query.get(venue_id)
+        if venue is None or venue.deleted_at_timestamp is not None:
+            with self.lock:
+                self.venues.deactivate(venue_id)
+            return
+        hours = self._venue_hours(venue_id).get(venue_id, 0)
+        with self.lock:
+            self.venues.upsert(*self._venue_record(venue, hours))
+
+    def remove_artist(self, artist_id):
+        with self.lock:
+            self.artists.deactivate(artist_id)
+
+    def remove_venue(self, venue_id):
+        with self.lock:
+            self.venues.deactivate(venue_id)
+
+    @staticmethod
+    def _scores(genres, state, city, artist_hours, venue_hours, table):
+        union = popcount(table.genres | genres)
+        shared = popcount(table.genres & genres)
+        genre_score = np.divide(shared, union, out=np.zeros(len(union)),
+                                where=union > 0)
+
+        same_state = (table.states == state) & (state >= 0)
+        same_city = same_state & (table.cities == city) & (city >= 0)
+
+        covered = popcount(artist_hours & venue_hours)
+        wanted = popcount(venue_hours)
+        # A venue with no booking history accepts any hour
+        availability = np.divide(covered, wanted, out=np.ones(len(covered)),
+                                 where=wanted > 0)
+
+        scores = (GENRE_WEIGHT * genre_score +
+                  STATE_WEIGHT * same_state +
+                  CITY_WEIGHT * same_city +
+                  AVAILABILITY_WEIGHT * availability)
+        # Without a single genre in common there is no match at all
+        scores[(shared == 0) | ~table.active] = -1
+        return scores
+
+    @staticmethod
+    def _top(table, scores, limit):
+        candidates = np.flatnonzero(scores >= 0)
+        if len(candidates) > limit:
+            best = np.argpartition(-scores[candidates], limit - 1)[:limit]
+            candidates = candidates[best]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [{"id": int(table.ids[row]), "score": round(float(scores[row]), 4)}
+                for row in candidates]
+
+    def venues_for_artist(self, artist_id, limit=10):
+        self.sync()
+        with self.lock:
+            row = self.artists.rows.get(artist_id)
+            if row is None or limit <= 0:
+                return []
+            table = self.venues
+            scores = self._scores(self.artists.genres[row],
+                                  self.artists.states[row],
+                                  self.artists.cities[row],
+                                  self.artists.hours[row],
+                                  table.hours, table)
+            return self._top(table, scores, limit)
+
+    def artists_for_venue(self, venue_id, limit=10):
+        self.sync()
+        with self.lock:
+            row = self.venues.rows.get(venue_id)
+            if row is None or limit <= 0:
+                return []
+            table = self.artists
+            scores = self._scores(self.venues.genres[row],
+                                  self.venues.states[row],
+                                  self.venues.cities[row],
+                                  table.hours,
+                                  self.venues.hours[row], table)
+            return self._top(table, scores, limit)
+
+
+match_index = MatchIndex()
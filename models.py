@@ -19,9 +19,15 @@ class Venue(db.Model):
     seeking_talent = db.Column(db.Boolean, default=False, nullable=False)
     seeking_description = db.Column(db.String, nullable=True)
     genres = db.Column(db.String, nullable=False)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
     shows = db.relationship("Show", backref="Venue")
     created_at_timestamp = db.Column(
         db.Float, default=datetime.timestamp(datetime.now()))
+    version = db.Column(db.Integer, nullable=False,
+                        default=1, server_default='1')
+    # Set by a soft bulk delete, the record is hidden from listings and search
+    deleted_at_timestamp = db.Column(db.Float, nullable=True)
 
     def __repr__(self):
         return f'<Venue (name : {self.name})>'
@@ -46,6 +52,10 @@ class Artist(db.Model):
     created_at_timestamp = db.Column(
         db.Float, default=datetime.timestamp(datetime.now()))
     availability_hours_24_format = db.Column(db.String(200))
+    version = db.Column(db.Integer, nullable=False,
+                        default=1, server_default='1')
+    # Set by a soft bulk delete, the record is hidden from listings and search
+    deleted_at_timestamp = db.Column(db.Float, nullable=True)
 
     def __repr__(self):
         return f'<Artist (name : {self.name})>'
@@ -62,3 +72,72 @@ class Show(db.Model):
 
     def __repr__(self):
         return f'<Show (artist_id: {self.artist_id}, venue_id : {self.venue_id})>'
+
+
+class ShowArchive(db.Model):
+    '''Shows moved out of the Show table by `flask archive-shows`.
+
+    On Postgres the table is range partitioned by start_time, one partition
+    per year (see archive.py), elsewhere it is a plain table. Ids are kept
+    from the Show table.
+    '''
+    __tablename__ = 'ShowArchive'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (start_time)'}
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    artist_id = db.Column(db.Integer, nullable=False, index=True)
+    venue_id = db.Column(db.Integer, nullable=False, index=True)
+    # A partitioned table's primary key must contain the partition key
+    start_time = db.Column(db.String, primary_key=True)
+
+    def __repr__(self):
+        return f'<ShowArchive (artist_id: {self.artist_id}, venue_id : {self.venue_id})>'
+
+
+#----------------------------------------------------------------------------#
+# Analytics rollups, maintained by analytics.py as shows are listed.
+#----------------------------------------------------------------------------#
+
+class VenueMonthlyShows(db.Model):
+    __tablename__ = 'VenueMonthlyShows'
+    venue_id = db.Column(db.Integer, primary_key=True)
+    # 'YYYY-MM'
+    month = db.Column(db.String(7), primary_key=True)
+    show_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CityShows(db.Model):
+    __tablename__ = 'CityShows'
+    city = db.Column(db.String(120), primary_key=True)
+    state = db.Column(db.String(120), primary_key=True)
+    show_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class GenreShows(db.Model):
+    __tablename__ = 'GenreShows'
+    genre = db.Column(db.String(120), primary_key=True)
+    show_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+
+
+class ArtistBookings(db.Model):
+    __tablename__ = 'ArtistBookings'
+    artist_id = db.Column(db.Integer, primary_key=True)
+    show_count = db.Column(db.Integer, nullable=False, default=0, index=True)
+    last_start_time = db.Column(db.String)
+
+
+class ChangeEvent(db.Model):
+    __tablename__ = 'ChangeEvent'
+    # Latest change of an entity (HTTP cache validators) and of a range of
+    # records (sitemap shards)
+    __table_args__ = (db.Index('ix_ChangeEvent_entity_id', 'entity', 'id'),
+                      db.Index('ix_ChangeEvent_entity_entity_id', 'entity', 'entity_id'))
+    # The id is the offset consumers of the change feed resume from
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.String, nullable=False, default='{}')
+    created_at_timestamp = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<ChangeEvent (id: {self.id}, {self.action} {self.entity} {self.entity_id})>'
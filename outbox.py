@@ -0,0 +1,143 @@
+import json
+import math
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, text
+
+from models import db, ChangeEvent
+
+#----------------------------------------------------------------------------#
+# Transactional outbox / change feed.
+#----------------------------------------------------------------------------#
+# Every handler that creates, edits or deletes an artist, a venue or a show
+# adds a ChangeEvent to the session before committing, so the event is stored
+# if and only if the change itself is. Consumers read the events in id order
+# and resume from the last id they processed.
+
+# Arbitrary key of the postgres advisory lock serializing outbox writers
+OUTBOX_LOCK_KEY = 72_2023
+MAX_BATCH = 1000
+MAX_WAIT = 30
+
+_new_events = threading.Condition()
+
+
+def _serialize_writers():
+    # Ids come from a sequence: without this, a transaction holding id 11
+    # could commit after the one holding id 12 and a consumer already past 12
+    # would never see 11. The lock is released by the commit or rollback.
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {"key": OUTBOX_LOCK_KEY})
+
+
+def snapshot(record):
+    return {column.name: getattr(record, column.name)
+            for column in record.__table__.columns}
+
+
+def record_change(entity, entity_id, action, payload=None):
+    '''Add a change event to the current transaction, the caller commits.'''
+    record_changes([(entity, entity_id, action, payload)])
+
+
+def record_changes(changes):
+    _serialize_writers()
+    now = datetime.timestamp(datetime.now())
+    db.session.bulk_insert_mappings(ChangeEvent, [{
+        "entity": entity,
+        "entity_id": entity_id,
+        "action": action,
+        "payload": json.dumps(payload or {}, default=str),
+        "created_at_timestamp": now,
+    } for entity, entity_id, action, payload in changes])
+
+
+def notify_consumers():
+    '''Wake the long polling consumers of this process, call after commit.'''
+    with _new_events:
+        _new_events.notify_all()
+
+
+def fetch_changes(after=0, limit=100):
+    events = ChangeEvent.query.filter(ChangeEvent.id > after).order_by(
+        ChangeEvent.id).limit(min(max(limit, 1), MAX_BATCH)).all()
+    return [{
+        "offset": event.id,
+        "entity": event.entity,
+        "entity_id": event.entity_id,
+        "action": event.action,
+        "payload": json.loads(event.payload),
+        "created_at_timestamp": event.created_at_timestamp,
+    } for event in events]
+
+
+def latest_offset():
+    return db.session.query(func.max(ChangeEvent.id)).scalar() or 0
+
+
+def changed_records(after, limit=200):
+    '''Ids of the artists and venues touched by the events after `after`,
+    as (offset, artist_ids, venue_ids). A show event counts for its venue.
+    Returns None when the caller is better off rebuilding: more than `limit`
+    events, or a show event without the venue in its payload.'''
+    events = fetch_changes(after, limit + 1)
+    if len(events) > limit:
+        return None
+    artist_ids, venue_ids = set(), set()
+    for event in events:
+        if event["entity"] == 'artist':
+            artist_ids.add(event["entity_id"])
+        elif event["entity"] == 'venue':
+            venue_ids.add(event["entity_id"])
+        elif event["entity"] == 'show':
+            if event["payload"].get("venue_id") is None:
+                return None
+            venue_ids.add(int(event["payload"]["venue_id"]))
+    offset = events[-1]["offset"] if events else after
+    return offset, artist_ids, venue_ids
+
+
+def rebuild_in_background(index):
+    '''Run index.build() on a thread of its own, the index keeps answering
+    from its current state meanwhile. At most one rebuild per index at once.'''
+    app = current_app._get_current_object()
+    with index.lock:
+        if index.rebuilding:
+            return
+        index.rebuilding = True
+
+    def rebuild():
+        try:
+            with app.app_context():
+                index.build()
+        except Exception:
+            app.logger.exception('rebuilding %s failed', type(index).__name__)
+        finally:
+            index.rebuilding = False
+
+    threading.Thread(target=rebuild, name=f'fyyur-rebuild-{type(index).__name__}',
+                     daemon=True).start()
+
+
+def wait_for_changes(after=0, limit=100, wait=0, poll_interval=0.5):
+    '''fetch_changes, blocking up to `wait` seconds while there is nothing new.
+
+    Commits made by this process wake the waiters at once, the ones made by
+    other workers are picked up by polling every `poll_interval` seconds.
+    '''
+    if not math.isfinite(wait):
+        wait = 0
+    deadline = time.monotonic() + min(max(wait, 0), MAX_WAIT)
+    while True:
+        events = fetch_changes(after, limit)
+        remaining = deadline - time.monotonic()
+        if events or not (0 < remaining <= MAX_WAIT):
+            return events
+        # End the read transaction so the next poll sees new commits
+        db.session.rollback()
+        with _new_events:
+            _new_events.wait(min(poll_interval, remaining))
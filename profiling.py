@@ -0,0 +1,189 @@
+import cProfile
+import hmac
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, abort, g, request
+
+#----------------------------------------------------------------------------#
+# Request profiling.
+#----------------------------------------------------------------------------#
+# Two ways of looking at slow pages in production:
+#   * on demand: a request carrying the profiler token (X-Fyyur-Profile header
+#     or ?_profile= parameter) runs under cProfile and its stats are written to
+#     PROFILE_DIR as a .pstats file, with a per layer summary in the response.
+#   * sampled: one request out of PROFILE_SAMPLE_EVERY is watched by a stack
+#     sampler, the stacks of every sampled request are aggregated and served as
+#     a flamegraph by /_profiler/flamegraph.
+
+PROFILE_HEADER = 'X-Fyyur-Profile'
+PROFILE_PARAMETER = '_profile'
+
+
+def layer(filename):
+    if 'sqlalchemy' in filename or 'psycopg2' in filename:
+        return 'db'
+    if 'jinja2' in filename or 'markupsafe' in filename or filename.endswith('.html'):
+        return 'render'
+    return 'app'
+
+
+def layer_times(profile):
+    '''Own time spent in the database, template rendering and everything else.'''
+    times = Counter()
+    for (filename, _, _), (_, _, own_time, _, _) in pstats.Stats(profile).stats.items():
+        times[layer(filename)] += own_time
+    return times
+
+
+class StackSampler:
+    '''Samples the stacks of registered threads from a background thread.'''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.threads = set()
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, thread_id):
+        with self.lock:
+            self.threads.add(thread_id)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name='fyyur-stack-sampler', daemon=True)
+                self.thread.start()
+
+    def unwatch(self, thread_id):
+        with self.lock:
+            self.threads.discard(thread_id)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                threads = list(self.threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            collected = []
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if stack:
+                    collected.append(';'.join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(collected)
+                self.samples += len(collected)
+
+    def reset(self):
+        with self.lock:
+            self.stacks = Counter()
+            self.samples = 0
+
+    def collapsed(self):
+        '''Brendan Gregg's collapsed stack format, one "a;b;c count" per line.'''
+        with self.lock:
+            stacks = list(self.stacks.items())
+        return '\n'.join(f'{stack} {count}' for stack, count in sorted(stacks)) + '\n'
+
+    def speedscope(self):
+        with self.lock:
+            stacks = list(self.stacks.items())
+        frames = {}
+        samples = []
+        weights = []
+        for stack, count in stacks:
+            samples.append([frames.setdefault(name, len(frames))
+                            for name in stack.split(';')])
+            weights.append(count * self.interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': [{'name': name} for name in frames]},
+            'profiles': [{
+                'type': 'sampled',
+                'name': 'Fyyur sampled requests',
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': samples,
+                'weights': weights,
+            }],
+        }
+
+
+sampler = StackSampler()
+
+
+def _authorized(app):
+    token = app.config.get('PROFILER_TOKEN')
+    supplied = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAMETER)
+    return bool(token and supplied) and hmac.compare_digest(token, supplied)
+
+
+def init_profiler(app):
+    sample_every = app.config.get('PROFILE_SAMPLE_EVERY', 0)
+    counter = itertools.count(1)
+
+    @app.before_request
+    def start_profiling():
+        if (request.endpoint or '').startswith('profiler_'):
+            return
+        if _authorized(app):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another request of this process is already being profiled
+                return
+            g.profile = profile
+        elif sample_every and next(counter) % sample_every == 0:
+            g.sampled_thread = threading.get_ident()
+            sampler.watch(g.sampled_thread)
+
+    @app.after_request
+    def stop_profiling(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+            os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{os.getpid()}.pstats"
+            profile.dump_stats(os.path.join(app.config['PROFILE_DIR'], name))
+            response.headers['X-Fyyur-Profile-Artifact'] = name
+            response.headers.add('Server-Timing', ', '.join(
+                f'profile-{layer_name};dur={seconds * 1000:.2f}'
+                for layer_name, seconds in sorted(layer_times(profile).items())))
+        return response
+
+    @app.teardown_request
+    def stop_sampling(exception=None):
+        thread_id = g.pop('sampled_thread', None)
+        if thread_id is not None:
+            sampler.unwatch(thread_id)
+
+    @app.route('/_profiler/flamegraph')
+    def profiler_flamegraph():
+        if not _authorized(app):
+            abort(404)
+        if request.args.get('format') == 'speedscope':
+            return Response(json.dumps(sampler.speedscope()),
+                            mimetype='application/json')
+        return Response(sampler.collapsed(), mimetype='text/plain')
+
+    @app.route('/_profiler/flamegraph', methods=['DELETE'])
+    def profiler_reset():
+        if not _authorized(app):
+            abort(404)
+        sampler.reset()
+        return '', 204
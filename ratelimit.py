@@ -0,0 +1,191 @@
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+import sessions
+
+#----------------------------------------------------------------------------#
+# Rate limiting and admission control.
+#----------------------------------------------------------------------------#
+# Every limited route belongs to a rule (RATELIMIT_RULES in config.py):
+#   * a token bucket per (client, route): `rate` requests per second on
+#     average, bursts of up to `burst` requests, answered 429 past that.
+#   * a cap on the requests of the rule running at the same time in this
+#     process, answered 503 past that instead of queueing behind the database.
+
+
+class MemoryBuckets:
+    '''Token buckets of this process only, at most max_keys of them. The
+    least recently used buckets go first, starting with the ones full again
+    (the same as no bucket), then the oldest ones past max_keys.'''
+
+    def __init__(self, max_keys=100_000):
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        '''Take a token, returns 0 when allowed or the seconds to wait.'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            # Each bucket keeps the time it is full again, rules differ
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            self.buckets.move_to_end(key)
+            self._evict(now)
+            return wait
+
+    def _evict(self, now):
+        while self.buckets:
+            oldest = next(iter(self.buckets.values()))
+            if oldest[2] > now and len(self.buckets) <= self.max_keys:
+                break
+            self.buckets.popitem(last=False)
+
+
+# KEYS[1] bucket, ARGV rate, burst, now. Returns the seconds to wait * 1000.
+TOKEN_BUCKET_SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return wait
+'''
+
+
+class RedisBuckets:
+    '''Token buckets shared by every worker and node, one redis hash each.'''
+
+    def __init__(self, client, prefix='fyyur:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        wait = self.client.eval(TOKEN_BUCKET_SCRIPT, 1,
+                                self.prefix + key, rate, burst, now)
+        return int(wait) / 1000
+
+
+class FakeRedis(sessions.FakeRedis):
+    '''Adds the token bucket script to the in process redis stand-in.'''
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = MemoryBuckets()
+
+    def eval(self, script, numkeys, key, rate, burst, now):
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise NotImplementedError('FakeRedis only runs the token bucket script')
+        wait = self.buckets.take(key, float(rate), float(burst), float(now))
+        return math.ceil(wait * 1000)
+
+
+class Limiter:
+
+    def __init__(self, buckets, rules):
+        self.buckets = buckets
+        self.rules = rules
+        self.slots = {name: threading.BoundedSemaphore(rule['concurrency'])
+                      for name, rule in rules.items() if rule.get('concurrency')}
+        self.metrics = Counter()
+        self.metrics_lock = threading.Lock()
+
+    def count(self, rule_name, outcome):
+        with self.metrics_lock:
+            self.metrics[(rule_name, outcome)] += 1
+
+    def statistics(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        statistics = {}
+        for (rule_name, outcome), count in sorted(metrics.items()):
+            statistics.setdefault(rule_name, {})[outcome] = count
+        return statistics
+
+
+def _client_id():
+    if current_app.config.get('RATELIMIT_TRUST_FORWARDED'):
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+
+def _reject(status, message, retry_after):
+    response = current_app.response_class(message, status=status, mimetype='text/plain')
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def limit(rule_name):
+    '''Apply the RATELIMIT_RULES[rule_name] rule to a view.'''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('fyyur_limiter')
+            if limiter is None or rule_name not in limiter.rules:
+                return view(*args, **kwargs)
+            rule = limiter.rules[rule_name]
+
+            try:
+                wait = limiter.buckets.take(
+                    f'{request.endpoint}:{_client_id()}', rule['rate'], rule['burst'])
+            except Exception:
+                # Never turn a limiter outage into an outage of the site
+                current_app.logger.exception('rate limiter unavailable')
+                limiter.count(rule_name, 'limiter_errors')
+                wait = 0
+            if wait:
+                limiter.count(rule_name, 'rate_limited')
+                return _reject(429, 'Too many requests, slow down.', wait)
+
+            slot = limiter.slots.get(rule_name)
+            if slot is not None and not slot.acquire(blocking=False):
+                limiter.count(rule_name, 'overloaded')
+                return _reject(503, 'The server is busy, try again in a moment.', 1)
+            try:
+                limiter.count(rule_name, 'allowed')
+                return view(*args, **kwargs)
+            finally:
+                if slot is not None:
+                    slot.release()
+        return wrapper
+    return decorator
+
+
+def init_limiter(app):
+    if not app.config.get('RATELIMIT_ENABLED', True):
+        return None
+    backend = app.config.get('RATELIMIT_BACKEND', 'memory')
+    if backend == 'memory':
+        buckets = MemoryBuckets()
+    elif backend == 'redis':
+        import redis
+        buckets = RedisBuckets(redis.Redis.from_url(app.config['RATELIMIT_REDIS_URL']))
+    elif backend == 'fake':
+        buckets = RedisBuckets(FakeRedis())
+    else:
+        raise ValueError(f"Unknown RATELIMIT_BACKEND {backend!r}")
+    limiter = Limiter(buckets, app.config.get('RATELIMIT_RULES', {}))
+    app.extensions['fyyur_limiter'] = limiter
+    return limiter
@@ -0,0 +1,133 @@
+import json
+from datetime import datetime
+
+from dateutil import parser
+from sqlalchemy import and_, or_
+
+from models import db, Artist, Show, Venue
+from outbox import record_changes
+import analytics
+
+#----------------------------------------------------------------------------#
+# Batch show scheduling.
+#----------------------------------------------------------------------------#
+
+START_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _parse_row(row):
+    try:
+        artist_id = int(row['artist_id'])
+        venue_id = int(row['venue_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('artist_id and venue_id must be integers')
+    start_time = row.get('start_time')
+    if isinstance(start_time, datetime):
+        parsed = start_time
+    else:
+        try:
+            parsed = parser.parse(str(start_time))
+        except (ValueError, OverflowError):
+            raise ValueError(f'invalid start_time {start_time!r}')
+    return artist_id, venue_id, parsed.replace(microsecond=0).strftime(START_TIME_FORMAT), parsed.hour
+
+
+def schedule_shows(rows):
+    '''Validate and insert a whole tour in one transaction.
+
+    Every row is checked against the artist's availability, the existing
+    bookings and the other rows of the batch using one query per table. If a
+    single row is rejected nothing is inserted. Returns the list of created
+    show dicts and the list of rejections ({"row": index, "reason": ...}).
+    '''
+    rejections = []
+    parsed = {}
+    for index, row in enumerate(rows):
+        try:
+            parsed[index] = _parse_row(row)
+        except ValueError as error:
+            rejections.append({"row": index, "reason": str(error)})
+
+    artist_ids = {artist_id for artist_id, _, _, _ in parsed.values()}
+    venue_ids = {venue_id for _, venue_id, _, _ in parsed.values()}
+    start_times = {start_time for _, _, start_time, _ in parsed.values()}
+
+    artists = {}
+    deleted_artists = set()
+    if artist_ids:
+        for artist_id, name, availability, deleted_at in db.session.query(
+                Artist.id, Artist.name, Artist.availability_hours_24_format,
+                Artist.deleted_at_timestamp).filter(Artist.id.in_(artist_ids)):
+            if deleted_at is not None:
+                deleted_artists.add(artist_id)
+            else:
+                artists[artist_id] = (name, availability)
+    known_venues = set()
+    deleted_venues = set()
+    if venue_ids:
+        for venue_id, deleted_at in db.session.query(
+                Venue.id, Venue.deleted_at_timestamp).filter(Venue.id.in_(venue_ids)):
+            if deleted_at is not None:
+                deleted_venues.add(venue_id)
+            else:
+                known_venues.add(venue_id)
+
+    booked_artists = set()
+    booked_venues = set()
+    if start_times:
+        for artist_id, venue_id, start_time in db.session.query(
+                Show.artist_id, Show.venue_id, Show.start_time).filter(
+                and_(Show.start_time.in_(start_times),
+                     or_(Show.artist_id.in_(artist_ids), Show.venue_id.in_(venue_ids)))):
+            booked_artists.add((artist_id, start_time))
+            booked_venues.add((venue_id, start_time))
+
+    blocked_hours = {}
+    for artist_id, (_, availability) in artists.items():
+        try:
+            blocked_hours[artist_id] = {int(hour) % 24 for hour in json.loads(availability or '[]')}
+        except (TypeError, ValueError):
+            blocked_hours[artist_id] = set()
+
+    accepted = []
+    for index, (artist_id, venue_id, start_time, hour) in sorted(parsed.items()):
+        if artist_id in deleted_artists:
+            reason = f'artist {artist_id} has been deleted'
+        elif artist_id not in artists:
+            reason = f'artist {artist_id} does not exist'
+        elif venue_id in deleted_venues:
+            reason = f'venue {venue_id} has been deleted'
+        elif venue_id not in known_venues:
+            reason = f'venue {venue_id} does not exist'
+        elif hour in blocked_hours[artist_id]:
+            reason = f'the artist {artists[artist_id][0]} is not available at this time'
+        elif (artist_id, start_time) in booked_artists:
+            reason = f'artist {artist_id} already has a show at {start_time}'
+        elif (venue_id, start_time) in booked_venues:
+            reason = f'venue {venue_id} already has a show at {start_time}'
+        else:
+            reason = None
+
+        if reason is not None:
+            rejections.append({"row": index, "reason": reason})
+            continue
+        # Later rows of the batch conflict with the ones accepted before them
+        booked_artists.add((artist_id, start_time))
+        booked_venues.add((venue_id, start_time))
+        accepted.append({"artist_id": artist_id,
+                         "venue_id": venue_id, "start_time": start_time})
+
+    rejections.sort(key=lambda rejection: rejection["row"])
+    if rejections or not accepted:
+        return [], rejections
+
+    try:
+        db.session.bulk_insert_mappings(Show, accepted, return_defaults=True)
+        record_changes([('show', show["id"], 'created', show)
+                        for show in accepted])
+        analytics.record_shows(accepted)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return accepted, []
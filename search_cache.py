@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from http_cache import change_marker
+
+#----------------------------------------------------------------------------#
+# Search result cache.
+#----------------------------------------------------------------------------#
+
+
+def normalize_term(term):
+    return ' '.join((term or '').split()).casefold()
+
+
+class _Flight:
+    '''A search being computed, the other callers for the same key wait on it.'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SearchCache:
+    '''LRU cache of search results keyed by (kind, normalized term).
+
+    Every kind ('artists', 'venues') has a generation: a counter bumped by the
+    handlers of this process that create, edit or delete records of that kind,
+    and the marker(kind) shared by every process, the latest outbox event that
+    can change its results. Entries store the generation they were computed
+    at and are dropped once it moved, so a write never has to find the
+    entries it invalidates, whichever worker made it. Entries also expire
+    after `ttl` seconds, which bounds how stale the upcoming show counts can
+    get as shows move from upcoming to past.
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=8 * 1024 * 1024, ttl=60, marker=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.marker = marker
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generations = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0,
+                      "evictions": 0, "invalidations": 0}
+
+    def bump(self, *kinds):
+        with self.lock:
+            for kind in kinds:
+                self.generations[kind] = self.generations.get(kind, 0) + 1
+                self.stats["invalidations"] += 1
+
+    def get_or_compute(self, kind, term, compute):
+        '''Return the cached results for term, calling compute(normalized_term)
+        at most once for all the concurrent identical searches on a miss.'''
+        term = normalize_term(term)
+        key = (kind, term)
+        shared = self._shared_generation(kind)
+        with self.lock:
+            generation = (self.generations.get(kind, 0), shared)
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, entry_generation, expires, size = entry
+                if entry_generation == generation and expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                self._discard(key)
+
+            flight = self.flights.get((key, generation))
+            if flight is not None:
+                self.stats["coalesced"] += 1
+                leader = False
+            else:
+                flight = self.flights[(key, generation)] = _Flight()
+                self.stats["misses"] += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute(term)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[(key, generation)]
+                if flight.error is None and self.generations.get(kind, 0) == generation[0]:
+                    self._store(key, flight.value, generation)
+            flight.done.set()
+        return flight.value
+
+    def _shared_generation(self, kind):
+        if self.marker is None:
+            return None
+        try:
+            return self.marker(kind)
+        except Exception:
+            # Left to the ttl, compute() reports the database being down
+            return None
+
+    def _store(self, key, value, generation):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        self._discard(key)
+        self.entries[key] = (value, generation,
+                             time.monotonic() + self.ttl, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._discard(oldest)
+            self.stats["evictions"] += 1
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+    def statistics(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+            return dict(self.stats,
+                        entries=len(self.entries),
+                        bytes=self.size,
+                        generations=dict(self.generations),
+                        hit_ratio=round(self.stats["hits"] / lookups, 4) if lookups else 0.0)
+
+
+# Outbox entities whose changes can alter the results of each kind
+KIND_ENTITIES = {
+    'artists': ('artist', 'show'),
+    'venues': ('venue', 'show'),
+}
+
+
+def outbox_marker(kind):
+    return change_marker(KIND_ENTITIES[kind])[0]
+
+
+search_cache = SearchCache(marker=outbox_marker)
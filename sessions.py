@@ -0,0 +1,221 @@
+import itertools
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+#----------------------------------------------------------------------------#
+# Server side sessions.
+#----------------------------------------------------------------------------#
+# With the default cookie sessions every worker has to share SECRET_KEY and
+# the whole session (flash messages, CSRF token) travels in the cookie.
+# These stores keep the session data on the server so any worker, on any
+# node, can read what another one wrote. The cookie only carries a signed id.
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+            session.accessed = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+
+    # Reads mark the session accessed, like Flask's cookie session does
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+
+class SQLiteSessionStore:
+    '''Sessions in a local SQLite file, shared by every worker of a node.
+    Expired sessions are deleted once every `purge_every` saves.'''
+
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self.saves = itertools.count(1)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS sessions '
+                '(sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, sid):
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT data FROM sessions WHERE sid = ? AND expires > ?',
+                (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, sid, data, ttl):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+                (sid, data, time.time() + ttl))
+        if self.purge_every and next(self.saves) % self.purge_every == 0:
+            self.purge_expired()
+
+    def delete(self, sid):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def purge_expired(self):
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM sessions WHERE expires <= ?', (time.time(),))
+
+
+class FakeRedis:
+    '''In process stand-in for the few redis commands RedisSessionStore uses.'''
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.data.get(key, (None, 0))
+            if value is not None and expires <= time.time():
+                del self.data[key]
+                return None
+            return value
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class RedisSessionStore:
+    '''Sessions in a redis server shared by every node.'''
+
+    def __init__(self, client, prefix='fyyur:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid):
+        return self.client.get(self.prefix + sid)
+
+    def set(self, sid, data, ttl):
+        self.client.setex(self.prefix + sid, int(ttl), data)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='fyyur-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.get(sid)
+                if data is not None:
+                    try:
+                        if isinstance(data, bytes):
+                            data = data.decode()
+                        return ServerSession(self.serializer.loads(data), sid=sid)
+                    except ValueError:
+                        pass
+        return ServerSession(sid=uuid4().hex, new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # The page depends on the session, shared caches must key on it
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified or self.should_set_cookie(app, session):
+            ttl = app.permanent_session_lifetime.total_seconds()
+            self.store.set(session.sid, self.serializer.dumps(dict(session)), ttl)
+
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def create_session_store(config):
+    backend = config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'sqlite':
+        return SQLiteSessionStore(config['SESSION_SQLITE_PATH'])
+    if backend == 'redis':
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(config['SESSION_REDIS_URL']))
+    if backend == 'fake':
+        return RedisSessionStore(FakeRedis())
+    if backend == 'cookie':
+        return None
+    raise ValueError(f"Unknown SESSION_BACKEND {backend!r}")
+
+
+def init_sessions(app):
+    backend = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend in ('sqlite', 'redis') and app.config.get('SECRET_KEY_IS_EPHEMERAL'):
+        raise RuntimeError(
+            'FYYUR_SECRET_KEY must be set when running with several workers, '
+            'otherwise every worker signs sessions and CSRF tokens with its own key.')
+    store = create_session_store(app.config)
+    if store is not None:
+        app.session_interface = ServerSessionInterface(store)
+    return store
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+from flask import Response, current_app, request, stream_with_context, url_for
+from sqlalchemy import func
+
+from models import db, Artist, ChangeEvent, Venue
+
+#----------------------------------------------------------------------------#
+# Sitemaps.
+#----------------------------------------------------------------------------#
+# /sitemap.xml lists one shard per SHARD_SIZE ids of each kind, so building it
+# only needs max(id). A shard streams its rows from a server side cursor and
+# takes lastmod from the outbox. Rendered shards are kept until an artist or
+# venue of their id range changes.
+#
+# URLs are built on SITEMAP_BASE_URL. Without it they fall back to the host of
+# the request, and the cache and ETag are then kept per host so a request with
+# a forged Host header can't change what other crawlers get.
+
+SHARD_SIZE = 10000
+CACHED_SHARDS = 256
+
+KINDS = {
+    'artists': (Artist, 'artist', 'show_artist', 'artist_id'),
+    'venues': (Venue, 'venue', 'show_venue', 'venue_id'),
+}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _w3c_date(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _base_url():
+    return (current_app.config.get('SITEMAP_BASE_URL') or request.host_url).rstrip('/')
+
+
+def sitemap_index():
+    base_url = _base_url()
+
+    def generate():
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for kind, (model, _, _, _) in KINDS.items():
+            max_id = db.session.query(func.max(model.id)).scalar() or 0
+            for shard in range(max_id // SHARD_SIZE + 1):
+                location = base_url + url_for('sitemap_shard', kind=kind, shard=shard)
+                yield f'  <sitemap><loc>{escape(location)}</loc></sitemap>\n'
+        yield '</sitemapindex>\n'
+    return Response(stream_with_context(generate()), mimetype='application/xml')
+
+
+def _shard_marker(entity, low, high):
+    return db.session.query(func.max(ChangeEvent.id)).filter(
+        ChangeEvent.entity == entity,
+        ChangeEvent.entity_id >= low, ChangeEvent.entity_id < high).scalar() or 0
+
+
+def _generate_shard(kind, low, high, marker, base_url):
+    model, entity, endpoint, argument = KINDS[kind]
+    last_changes = dict(db.session.query(
+        ChangeEvent.entity_id, func.max(ChangeEvent.created_at_timestamp)).filter(
+        ChangeEvent.entity == entity,
+        ChangeEvent.entity_id >= low, ChangeEvent.entity_id < high).group_by(
+        ChangeEvent.entity_id))
+
+    rows = db.session.query(model.id, model.created_at_timestamp).filter(
+        model.id >= low, model.id < high,
+        model.deleted_at_timestamp.is_(None)).order_by(model.id).execution_options(
+        stream_results=True).yield_per(1000)
+
+    chunks = []
+    head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    chunks.append(head)
+    yield head
+    for record_id, created_at in rows:
+        location = base_url + url_for(endpoint, **{argument: record_id})
+        lastmod = last_changes.get(record_id) or created_at
+        entry = f'  <url><loc>{escape(location)}</loc>'
+        if lastmod:
+            entry += f'<lastmod>{_w3c_date(lastmod)}</lastmod>'
+        entry += '</url>\n'
+        chunks.append(entry)
+        yield entry
+    tail = '</urlset>\n'
+    chunks.append(tail)
+    yield tail
+
+    # Only reached when the whole shard was sent
+    with _cache_lock:
+        _cache[(kind, low, base_url)] = (marker, ''.join(chunks))
+        _cache.move_to_end((kind, low, base_url))
+        while len(_cache) > CACHED_SHARDS:
+            _cache.popitem(last=False)
+
+
+def sitemap_shard(kind, shard):
+    model, entity, _, _ = KINDS[kind]
+    low, high = shard * SHARD_SIZE, (shard + 1) * SHARD_SIZE
+    marker = _shard_marker(entity, low, high)
+    base_url = _base_url()
+    host_hash = hashlib.sha1(base_url.encode()).hexdigest()[:8]
+    etag = f'{kind}-{shard}-{marker}-{host_hash}'
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    with _cache_lock:
+        cached = _cache.get((kind, low, base_url))
+    if cached is not None and cached[0] == marker:
+        response = Response(cached[1], mimetype='application/xml')
+    else:
+        response = Response(stream_with_context(
+            _generate_shard(kind, low, high, marker, base_url)), mimetype='application/xml')
+    response.set_etag(etag, weak=True)
+    return response
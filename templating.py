@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from jinja2 import FileSystemBytecodeCache, Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#----------------------------------------------------------------------------#
+# Templates.
+#----------------------------------------------------------------------------#
+# Compiled templates are kept in TEMPLATE_CACHE_DIR, so a restarted worker
+# loads bytecode instead of compiling every template again, and every template
+# is loaded when the app starts rather than by the first request using it.
+#
+# Every request also measures the time spent in SQL statements and in
+# rendering templates. Both are sent in the Server-Timing header and
+# aggregated per template and per endpoint for /_metrics/templates.
+
+
+class RenderMetrics:
+
+    def __init__(self):
+        self.templates = {}
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def add_render(self, name, seconds):
+        with self.lock:
+            stats = self.templates.setdefault(name, Counter())
+            stats['renders'] += 1
+            stats['total_ms'] += seconds * 1000
+            stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+
+    def add_request(self, endpoint, total, db_time, render_time):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, Counter())
+            stats['requests'] += 1
+            stats['total_ms'] += total * 1000
+            stats['db_ms'] += db_time * 1000
+            stats['render_ms'] += render_time * 1000
+
+    def reset(self):
+        with self.lock:
+            self.templates = {}
+            self.endpoints = {}
+
+    def statistics(self):
+        with self.lock:
+            templates = {name: dict(stats) for name, stats in self.templates.items()}
+            endpoints = {name: dict(stats) for name, stats in self.endpoints.items()}
+        for stats in templates.values():
+            stats['mean_ms'] = stats['total_ms'] / stats['renders']
+        for stats in endpoints.values():
+            stats['mean_ms'] = stats['total_ms'] / stats['requests']
+            stats['other_ms'] = stats['total_ms'] - stats['db_ms'] - stats['render_ms']
+        return {
+            "templates": {name: {key: round(value, 3) for key, value in stats.items()}
+                          for name, stats in sorted(templates.items())},
+            "endpoints": {name: {key: round(value, 3) for key, value in stats.items()}
+                          for name, stats in sorted(endpoints.items())},
+        }
+
+
+render_metrics = RenderMetrics()
+
+
+class TimedTemplate(Template):
+    '''Template adding its render time to the request and to render_metrics.'''
+
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            render_metrics.add_render(self.name, elapsed)
+            if has_request_context():
+                g.render_time = g.get('render_time', 0) + elapsed
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, dropped with it when the statement fails
+    if context is not None:
+        context.fyyur_statement_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'fyyur_statement_start', None)
+    if start is not None and has_request_context():
+        g.db_time = g.get('db_time', 0) + time.perf_counter() - start
+
+
+def prewarm_templates(app):
+    '''Load every template, from the bytecode cache when it has them.'''
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def init_templates(app):
+    app.jinja_env.template_class = TimedTemplate
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    if app.config.get('TEMPLATE_PREWARM', True):
+        prewarm_templates(app)
+
+    @app.before_request
+    def start_timing():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def report_timing(response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        db_time = g.get('db_time', 0)
+        render_time = g.get('render_time', 0)
+        render_metrics.add_request(request.endpoint or 'unknown', total, db_time, render_time)
+        response.headers.add(
+            'Server-Timing', f'db;dur={db_time * 1000:.2f}, render;dur={render_time * 1000:.2f}, '
+                             f'total;dur={total * 1000:.2f}')
+        return response
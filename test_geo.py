@@ -0,0 +1,75 @@
+import random
+
+from geo import MAX_RADIUS_MILES, VenueGrid, haversine_miles
+
+
+def _grid(venues):
+    grid = VenueGrid()
+    grid.built = True
+    # No database here, nothing to catch up with
+    grid.sync = lambda: None
+    for venue_id, (latitude, longitude) in venues.items():
+        grid.update_venue(venue_id, latitude, longitude)
+    return grid
+
+
+def _brute_force(venues, latitude, longitude):
+    return sorted(haversine_miles(latitude, longitude, *position)
+                  for position in venues.values())
+
+
+def test_nearest_matches_brute_force():
+    generator = random.Random(7)
+    for _ in range(300):
+        venues = {venue_id: (generator.uniform(-85, 85), generator.uniform(-180, 180))
+                  for venue_id in range(1, generator.randint(1, 30))}
+        grid = _grid(venues)
+        latitude, longitude = generator.uniform(-85, 85), generator.uniform(-180, 180)
+        k = generator.randint(1, 8)
+        expected = _brute_force(venues, latitude, longitude)[:k]
+        found = [miles for miles, _ in grid.nearest(latitude, longitude, k)]
+        assert [round(miles, 6) for miles in found] == [round(miles, 6) for miles in expected]
+
+
+def test_nearest_in_a_dense_grid_matches_brute_force():
+    # Enough venues for the search to stop on the ring bound, up north where
+    # a degree of longitude is short
+    generator = random.Random(3)
+    venues = {venue_id: (generator.uniform(25, 75), generator.uniform(-170, -50))
+              for venue_id in range(1, 3000)}
+    grid = _grid(venues)
+    for _ in range(100):
+        latitude, longitude = generator.uniform(25, 75), generator.uniform(-170, -50)
+        k = generator.randint(1, 10)
+        expected = _brute_force(venues, latitude, longitude)[:k]
+        found = [miles for miles, _ in grid.nearest(latitude, longitude, k)]
+        assert [round(miles, 6) for miles in found] == [round(miles, 6) for miles in expected]
+
+
+def test_nearest_across_the_antimeridian():
+    grid = _grid({1: (10.0, 179.9), 2: (10.0, 170.0)})
+    assert grid.nearest(10.0, -179.9, 1)[0][1] == 1
+    assert [venue_id for _, venue_id in grid.within(10.0, -179.9, 50)] == [1]
+
+
+def test_within_matches_brute_force():
+    generator = random.Random(11)
+    for _ in range(100):
+        venues = {venue_id: (generator.uniform(30, 50), generator.uniform(-125, -70))
+                  for venue_id in range(1, 40)}
+        grid = _grid(venues)
+        latitude, longitude = generator.uniform(30, 50), generator.uniform(-125, -70)
+        radius = generator.uniform(10, 500)
+        expected = sorted(venue_id for venue_id, position in venues.items()
+                          if haversine_miles(latitude, longitude, *position) <= radius)
+        assert sorted(venue_id for _, venue_id in grid.within(
+            latitude, longitude, radius)) == expected
+
+
+def test_within_the_whole_globe():
+    generator = random.Random(5)
+    venues = {venue_id: (generator.uniform(-89, 89), generator.uniform(-180, 180))
+              for venue_id in range(1, 50)}
+    grid = _grid(venues)
+    assert sorted(venue_id for _, venue_id in grid.within(
+        89.9, 0.0, MAX_RADIUS_MILES)) == sorted(venues)
@@ -0,0 +1,56 @@
+from sqlalchemy import String
+
+from models import db
+
+#----------------------------------------------------------------------------#
+# Optimistic concurrency for artist / venue edits.
+#----------------------------------------------------------------------------#
+
+
+class EditConflict(Exception):
+    '''The record was modified (or deleted, soft deletes included) since the
+    edit form was loaded.'''
+
+
+def _coerce(column, value):
+    # Some form fields (VenueForm.phone) are not strings but the columns are
+    if value is not None and isinstance(column.type, String) and not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def changed_fields(record, data):
+    '''The subset of data whose values differ from the loaded record.'''
+    columns = record.__table__.columns
+    changes = {}
+    for name, value in data.items():
+        if name not in columns or name in ('id', 'version'):
+            continue
+        value = _coerce(columns[name], value)
+        if getattr(record, name) != value:
+            changes[name] = value
+    return changes
+
+
+def compare_and_swap(model, record_id, version, data):
+    '''Write only the fields of data that changed, if the record is still at
+    `version`. Returns the changed fields, raises EditConflict otherwise.
+
+    The caller commits. The version check and the write are one UPDATE, so
+    two workers saving the same record can't both succeed.
+    '''
+    record = db.session.get(model, record_id)
+    if record is None or record.version != version or record.deleted_at_timestamp is not None:
+        raise EditConflict()
+
+    changes = changed_fields(record, data)
+    if not changes:
+        return changes
+
+    updated = db.session.query(model).filter(
+        model.id == record_id, model.version == version,
+        model.deleted_at_timestamp.is_(None)).update(
+        dict(changes, version=model.version + 1), synchronize_session=False)
+    if updated != 1:
+        raise EditConflict()
+    return changes